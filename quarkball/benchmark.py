@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+quarkball2017: benchmarks of loading, scoring and filling
+
+Time the loaders, the scoring engines and the fill strategies on the input
+datasets, save the results to JSON (with the environment information),
+and compare them against a stored baseline to flag regressions.
+"""
+
+# ======================================================================
+# :: Imports
+from __future__ import (
+    division, absolute_import, print_function, unicode_literals)
+
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import socket
+import argparse
+import datetime
+import platform
+import tempfile
+import contextlib
+import subprocess
+import multiprocessing
+
+import numpy as np
+
+from quarkball import utils
+from quarkball.utils import Network, Caching, SCORE_ENGINES
+import quarkball.fill_caching as fill
+
+DIRPATH = 'data'
+IN_DIRPATH = os.path.join(DIRPATH, 'input')
+OUT_DIRPATH = os.path.join(DIRPATH, 'output')
+SOURCES = (
+    'example', 'me_at_the_zoo', 'trending_today', 'videos_worth_spreading')
+
+# the fill strategies: (class, keyword arguments, whether to use a file)
+# the runs are bounded (and seeded) to have stable timings and scores
+STRATEGIES = {
+    'random': (Caching, {}, False),
+    'random_seed': (fill.CachingRandomSeed, {}, False),
+    'optim_by_requests': (fill.CachingOptimByRequests, {}, False),
+    'optim_by_caches': (fill.CachingOptimByCaches, {}, False),
+    'greedy_gain': (fill.CachingGreedyGain, {}, False),
+    'block_ascent': (fill.CachingBlockAscent, dict(max_sweeps=2), False),
+    'local_search': (fill.CachingLocalSearch, dict(max_sweeps=1), False),
+    'annealing': (
+        fill.CachingAnnealing, dict(max_iter=20000, reheat_after=None),
+        False),
+    'montecarlo': (
+        fill.CachingMonteCarlo, dict(max_iter=64, batch_size=16), True),
+    'evolution': (
+        fill.CachingEvolution,
+        dict(max_generations=2, pool_size=20, multiproc=False), True),
+    'bruteforce': (fill.CachingBruteForce, dict(max_time=1.0), False),
+}
+
+BENCHMARKS = (
+    ('network_load', 'network_load_mapped', 'caching_load', 'caching_save') +
+    tuple('score_' + engine for engine in SCORE_ENGINES) +
+    tuple('fill_' + name for name in STRATEGIES))
+
+
+# ======================================================================
+def environment():
+    """
+    Collect the information on the environment of a benchmark run.
+
+    Returns:
+        info (dict): The environment information.
+    """
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    try:
+        import numba
+    except ImportError:
+        numba_version = None
+    else:
+        numba_version = numba.__version__
+    return dict(
+        date=datetime.datetime.now().isoformat(),
+        hostname=socket.gethostname(),
+        platform=platform.platform(),
+        processor=platform.processor(),
+        cpu_count=multiprocessing.cpu_count(),
+        python=sys.version,
+        numpy=np.__version__,
+        numba=numba_version,
+        score_engine=utils.SCORE_ENGINE,
+        commit=commit)
+
+
+# ======================================================================
+def _timed(func, repeat=3, warmup=1, verbose=False):
+    # run `warmup` times untimed, then time `repeat` runs
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(sys.stdout if verbose else devnull):
+        result = None
+        for _ in range(warmup):
+            result = func()
+        times = []
+        for _ in range(repeat):
+            begin_time = time.perf_counter()
+            result = func()
+            times.append(time.perf_counter() - begin_time)
+    return times, result
+
+
+# ======================================================================
+def _fill_run(network, strategy, tmp_dirpath, seed):
+    fill_cls, fill_kws, use_file = STRATEGIES[strategy]
+    random.seed(seed)
+    np.random.seed(seed)
+    if use_file:
+        run_dirpath = tempfile.mkdtemp(dir=tmp_dirpath)
+        fill_kws = dict(
+            fill_kws, filepath=os.path.join(run_dirpath, 'benchmark.out'))
+    caching = fill_cls(network.num_caches)
+    caching.fill(network, **fill_kws)
+    if use_file:
+        shutil.rmtree(run_dirpath)
+    return caching.score(network)
+
+
+# ======================================================================
+def run(
+        sources=SOURCES,
+        benchmarks=BENCHMARKS,
+        in_dirpath=IN_DIRPATH,
+        out_dirpath=OUT_DIRPATH,
+        repeat=3,
+        warmup=1,
+        seed=0,
+        verbose=False):
+    """
+    Run the benchmarks.
+
+    Args:
+        sources (Iterable[str]): The names of the datasets.
+        benchmarks (Iterable[str]): The names of the benchmarks.
+            Accepted values are in `BENCHMARKS`:
+             - 'network_load': `Network.load()` parsing the input;
+             - 'network_load_mapped': `Network.load()` from the sidecar;
+             - 'caching_load': `Caching.load()` of the output;
+             - 'caching_save': `Caching.save()` of the output;
+             - 'score_<engine>': `Network.score_placement()` of the output;
+             - 'fill_<strategy>': `fill()` of the strategy (see
+               `STRATEGIES`), on an empty caching.
+        in_dirpath (str): The directory of the `.in` files.
+        out_dirpath (str): The directory of the `.out` files.
+            These are the cachings loaded, saved and scored.
+        repeat (int): The number of timed runs.
+        warmup (int): The number of untimed runs before the timed ones.
+            These also compile the Numba kernels.
+        seed (int): The seed of the random generators of the fill runs.
+        verbose (bool): Show the output of the benchmarked functions.
+
+    Returns:
+        results (dict): The results.
+            - `environment`: see `environment()`;
+            - `config`: the parameters of the run;
+            - `results`: the list of the results of each benchmark on each
+              dataset, with the `source` and `benchmark` names, the
+              `times` in s and their `min`, `median` and `mean`, and the
+              `score` for the fill strategies.
+    """
+    results = []
+    tmp_dirpath = tempfile.mkdtemp()
+    try:
+        for source in sources:
+            in_filepath = os.path.join(in_dirpath, source + '.in')
+            out_filepath = os.path.join(out_dirpath, source + '.out')
+            network = Network.load(in_filepath, cache=False)
+            caching = Caching.load(out_filepath)
+            placement = utils._placement(caching, network.num_videos)
+            tasks = {
+                'network_load':
+                    lambda: Network.load(in_filepath, cache=False),
+                'network_load_mapped':
+                    lambda: Network.load(in_filepath),
+                'caching_load':
+                    lambda: Caching.load(out_filepath),
+                'caching_save':
+                    lambda: caching.save(
+                        os.path.join(tmp_dirpath, source + '.out')),
+            }
+            for engine in SCORE_ENGINES:
+                tasks['score_' + engine] = \
+                    lambda engine=engine: network.score_placement(
+                        placement, engine)
+            for strategy in STRATEGIES:
+                tasks['fill_' + strategy] = \
+                    lambda strategy=strategy: _fill_run(
+                        network, strategy, tmp_dirpath, seed)
+            for benchmark in benchmarks:
+                if benchmark not in tasks:
+                    raise ValueError(
+                        'Unknown benchmark `{}`!'.format(benchmark))
+                times, result = _timed(
+                    tasks[benchmark], repeat, warmup, verbose)
+                entry = dict(
+                    source=source, benchmark=benchmark, times=times,
+                    min=min(times), median=float(np.median(times)),
+                    mean=float(np.mean(times)))
+                if benchmark.startswith('fill_'):
+                    entry['score'] = int(result)
+                results.append(entry)
+                print('{:24s} {:28s} t={:.4f} s{}'.format(
+                    source, benchmark, entry['median'],
+                    '  SCORE: {}'.format(entry['score'])
+                    if 'score' in entry else ''), flush=True)
+    finally:
+        shutil.rmtree(tmp_dirpath)
+    return dict(
+        environment=environment(),
+        config=dict(
+            sources=list(sources), benchmarks=list(benchmarks),
+            repeat=repeat, warmup=warmup, seed=seed),
+        results=results)
+
+
+# ======================================================================
+def save(results, filepath):
+    """
+    Save the benchmark results to a JSON file.
+
+    Args:
+        results (dict): The results. See `run()` for more info.
+        filepath (str): The output file.
+
+    Returns:
+        None.
+    """
+    tmp_filepath = '{}.{}.tmp'.format(filepath, os.getpid())
+    with open(tmp_filepath, 'w') as file:
+        json.dump(results, file, indent=2)
+    os.replace(tmp_filepath, filepath)
+
+
+# ======================================================================
+def load(filepath):
+    """
+    Load the benchmark results from a JSON file.
+
+    Args:
+        filepath (str): The input file.
+
+    Returns:
+        results (dict): The results. See `run()` for more info.
+    """
+    with open(filepath, 'r') as file:
+        return json.load(file)
+
+
+# ======================================================================
+def compare(
+        results,
+        baseline,
+        time_tolerance=0.25,
+        min_time_delta=0.005,
+        score_tolerance=0):
+    """
+    Compare benchmark results against a baseline.
+
+    Only the benchmarks present in both are compared.
+    The median times are compared, since they are robust to outliers.
+    Timings depend on the machine: check that the environments match.
+
+    Args:
+        results (dict): The results. See `run()` for more info.
+        baseline (dict): The baseline results.
+        time_tolerance (float): The tolerated relative time increase.
+        min_time_delta (float): The tolerated absolute time increase in s.
+            A time regression must exceed both tolerances.
+        score_tolerance (int): The tolerated score decrease.
+
+    Returns:
+        regressions (list[dict]): The regressions.
+            Each regression has the `source`, `benchmark` and `kind`
+            ('time' or 'score') and the `baseline` and `current` values.
+    """
+    baseline_entries = {
+        (entry['source'], entry['benchmark']): entry
+        for entry in baseline['results']}
+    regressions = []
+    for entry in results['results']:
+        key = entry['source'], entry['benchmark']
+        if key not in baseline_entries:
+            continue
+        old_entry = baseline_entries[key]
+        if entry['median'] > old_entry['median'] * (1 + time_tolerance) and \
+                entry['median'] - old_entry['median'] > min_time_delta:
+            regressions.append(dict(
+                source=key[0], benchmark=key[1], kind='time',
+                baseline=old_entry['median'], current=entry['median']))
+        if 'score' in entry and 'score' in old_entry and \
+                entry['score'] < old_entry['score'] - score_tolerance:
+            regressions.append(dict(
+                source=key[0], benchmark=key[1], kind='score',
+                baseline=old_entry['score'], current=entry['score']))
+    for key in ('platform', 'processor', 'cpu_count', 'score_engine'):
+        if results['environment'].get(key) != \
+                baseline['environment'].get(key):
+            print('W: Different `{}`: {} (baseline: {})'.format(
+                key, results['environment'].get(key),
+                baseline['environment'].get(key)))
+    for regression in regressions:
+        print('W: {kind} regression - {source:20s} {benchmark:28s} '
+              '{baseline} -> {current}'.format(**regression))
+    return regressions
+
+
+# ======================================================================
+def handle_arg():
+    """
+    Handle command-line application arguments.
+    """
+    arg_parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument(
+        '-s', '--sources', nargs='+', default=SOURCES,
+        help='the datasets to use [%(default)s]')
+    arg_parser.add_argument(
+        '-b', '--benchmarks', nargs='+', default=BENCHMARKS,
+        choices=BENCHMARKS, metavar='BENCHMARK',
+        help='the benchmarks to run [%(default)s]')
+    arg_parser.add_argument(
+        '-i', '--in_dirpath', default=IN_DIRPATH,
+        help='the directory of the input files [%(default)s]')
+    arg_parser.add_argument(
+        '-d', '--out_dirpath', default=OUT_DIRPATH,
+        help='the directory of the output files [%(default)s]')
+    arg_parser.add_argument(
+        '-r', '--repeat', type=int, default=3,
+        help='the number of timed runs [%(default)s]')
+    arg_parser.add_argument(
+        '-w', '--warmup', type=int, default=1,
+        help='the number of untimed runs [%(default)s]')
+    arg_parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='show the output of the benchmarked functions [%(default)s]')
+    arg_parser.add_argument(
+        '--seed', type=int, default=0,
+        help='the seed of the fill runs [%(default)s]')
+    arg_parser.add_argument(
+        '-o', '--output',
+        help='the file to save the results to (JSON)')
+    arg_parser.add_argument(
+        '-c', '--compare', metavar='BASELINE',
+        help='the baseline results to compare against (JSON)')
+    arg_parser.add_argument(
+        '--results',
+        help='compare these results instead of running the benchmarks')
+    arg_parser.add_argument(
+        '--time_tolerance', type=float, default=0.25,
+        help='the tolerated relative time increase [%(default)s]')
+    arg_parser.add_argument(
+        '--score_tolerance', type=int, default=0,
+        help='the tolerated score decrease [%(default)s]')
+    return arg_parser
+
+
+# ======================================================================
+def main():
+    arg_parser = handle_arg()
+    args = arg_parser.parse_args()
+    if args.results:
+        results = load(args.results)
+    else:
+        results = run(
+            args.sources, args.benchmarks, args.in_dirpath,
+            args.out_dirpath, args.repeat, args.warmup, args.seed,
+            args.verbose)
+    if args.output:
+        save(results, args.output)
+    if args.compare:
+        regressions = compare(
+            results, load(args.compare), args.time_tolerance,
+            score_tolerance=args.score_tolerance)
+        print('\n{} regression(s)'.format(len(regressions)))
+        return 1 if regressions else 0
+    return 0
+
+
+# ======================================================================
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,17 +3,23 @@
 
 import os
 import random
-import itertools
+import contextlib
 import datetime
 import operator
 import shutil
-import copy
-import multiprocessing
+import heapq
+import json
+import math
+import threading
 import time
 
 import numpy as np
 
-from quarkball.utils import Network, Caching, jit
+from quarkball.utils import (
+    Network, Caching, CachingMatrix, Evaluator, jit, njit, knapsack,
+    overflows, _placement)
+from quarkball.parallel import (
+    WorkerPool, attach_arrays, worker_network, worker_lock)
 
 
 # random.seed(0)
@@ -37,27 +43,138 @@ def _random_cache(videos, avail_cache, min_video_size=None):
 
 
 # ======================================================================
-def _breeding(pool, network, crossover=0.5, mutation_rate=0.1, mutation=0.01):
-    pool = sorted(pool, key=operator.itemgetter(0), reverse=True)
-    score, caching = copy.deepcopy(pool[0])
-    min_video_size = np.min(network.videos)
-    if crossover is None:
-        raise NotImplementedError('Dynamic recombination not implemented!')
+def _random_draws(num, sizes, cache_size, num_passes=3):
+    # random caches: the videos drawn in random order, as long as they fit
+    # (approximated with a few passes of cumulative-size cutoffs, and
+    # videos drawn more than once are counted for each draw)
+    sizes = np.asarray(sizes, dtype=np.int64)
+    num_videos = len(sizes)
+    num_draws = min(num_videos, 2 * int(cache_size / np.mean(sizes)) + 16)
+    if num_draws == num_videos:
+        draws = np.argsort(np.random.random((num, num_videos)), axis=1)
     else:
-        # crossover
-        other_caching = pool[1][1]
-        for i in random.sample(range(network.num_caches),
-                               int(network.num_caches * (1 - crossover))):
-            caching.caches[i] = copy.deepcopy(other_caching.caches[i])
-
-        # mutation
-        if random.random() >= mutation_rate:
-            for i in random.sample(range(network.num_caches),
-                                   int(network.num_caches * mutation)):
-                caching.caches[i] = _random_cache(
-                    network.videos, network.cache_size, min_video_size)
-    score = caching.score(network)
-    return score, caching
+        draws = np.random.randint(num_videos, size=(num, num_draws))
+    draw_sizes = sizes[draws]
+    taken = np.zeros(draws.shape, dtype=bool)
+    free = np.full((num, 1), cache_size, dtype=np.int64)
+    for _ in range(num_passes):
+        fitting = ~taken & (draw_sizes <= free)
+        added = fitting & (np.cumsum(draw_sizes * fitting, axis=1) <= free)
+        taken |= added
+        free -= np.sum(draw_sizes * added, axis=1, keepdims=True)
+    return draws, taken
+
+
+# ======================================================================
+def _random_placements(num, sizes, cache_size):
+    draws, taken = _random_draws(num, sizes, cache_size)
+    placements = np.zeros((num, len(sizes)), dtype=bool)
+    rows = np.broadcast_to(np.arange(num)[:, None], draws.shape)
+    placements[rows[taken], draws[taken]] = True
+    return placements
+
+
+# ======================================================================
+def _saving_bounds(network):
+    # the saving of each video in each cache alone, and in all caches
+    gains = Evaluator(network).gains()
+    degrees = np.diff(network.link_offsets)[network.req_endpoint]
+    min_latencies = np.where(
+        degrees > 0,
+        network.link_latencies[np.minimum(
+            network.link_offsets[network.req_endpoint],
+            len(network.link_latencies) - 1)],
+        network.endpoint_latencies[network.req_endpoint])
+    # as in `Network.upper_bound()`, slower links save nothing
+    max_gains = np.bincount(
+        network.req_video,
+        np.maximum(
+            network.endpoint_latencies[network.req_endpoint] - min_latencies,
+            0) * network.req_count.astype(np.int64),
+        minlength=network.num_videos)
+    return gains, max_gains
+
+
+# ======================================================================
+def _stop_score(network, stop_at_gap):
+    # the score reaching the gap from the upper bound (see `Network.gap()`)
+    if stop_at_gap is None:
+        return np.inf
+    return network.upper_bound() * (1 - stop_at_gap)
+
+
+# ======================================================================
+def _repair(placements, sizes, cache_size):
+    # drop random videos from the overflowing caches (in-place)
+    sizes = np.asarray(sizes, dtype=np.int64)
+    rows = placements.reshape(-1, placements.shape[-1])
+    row_index, video_index = np.nonzero(rows)
+    loads = np.bincount(row_index, sizes[video_index], minlength=len(rows))
+    overflowing = np.flatnonzero(loads > cache_size)
+    if len(overflowing):
+        held = rows[overflowing]
+        order = np.argsort(
+            np.where(held, np.random.random(held.shape), np.inf), axis=1)
+        held = np.take_along_axis(held, order, axis=1)
+        kept = held & (np.cumsum(sizes[order] * held, axis=1) <= cache_size)
+        np.put_along_axis(held, order, kept, axis=1)
+        rows[overflowing] = held
+    return len(overflowing)
+
+
+# ======================================================================
+def _score_population(population, first, last, network):
+    # unpack, repair (in-place) and score part of a packed population
+    placements = np.unpackbits(
+        population[first:last], axis=-1, count=network.num_videos).view(bool)
+    if _repair(placements, network.videos, network.cache_size):
+        population[first:last] = np.packbits(placements, axis=-1)
+    return network.score_placement(placements)
+
+
+# ======================================================================
+def _score_population_task(handle, first, last):
+    return _score_population(
+        attach_arrays(handle)['population'], first, last, worker_network())
+
+
+# ======================================================================
+def _population_scores(population, network, mp_pool=None, shared=None):
+    num_individuals = len(population)
+    batch_size = max(1, 2 ** 26 // (network.num_caches * network.num_videos))
+    if mp_pool is not None:
+        batch_size = min(
+            batch_size, -(-num_individuals // mp_pool.processes))
+    bounds = list(range(0, num_individuals, batch_size)) + [num_individuals]
+    if mp_pool is None:
+        return np.concatenate([
+            _score_population(population, first, last, network)
+            for first, last in zip(bounds[:-1], bounds[1:])])
+    else:
+        handle, buffer = shared
+        buffer[:num_individuals] = population
+        results = [
+            mp_pool.apply_async(_score_population_task, (handle, first, last))
+            for first, last in zip(bounds[:-1], bounds[1:])]
+        scores = np.concatenate([result.get() for result in results])
+        population[...] = buffer[:num_individuals]
+        return scores
+
+
+# ======================================================================
+def _check_population(population, network):
+    # all the caches must fit after the repair
+    invalid = np.any(
+        overflows(population, network.videos, network.cache_size), axis=-1)
+    if np.any(invalid):
+        raise RuntimeError('Invalid individuals after repair: {}'.format(
+            np.flatnonzero(invalid).tolist()))
+
+
+# ======================================================================
+def _random_cache_task(min_video_size):
+    network = worker_network()
+    return _random_cache(network.videos, network.cache_size, min_video_size)
 
 
 # ======================================================================
@@ -66,16 +183,13 @@ class CachingRandomPar(Caching):
         Caching.__init__(self, *args, **kwargs)
 
     # ----------------------------------------------------------
-    def fill(self, network):
+    def fill(self, network, processes=None, seed=None):
         min_video_size = np.min(network.videos)
-        mp_pool = multiprocessing.Pool(multiprocessing.cpu_count())
-        results = [
-            mp_pool.apply_async(
-                _random_cache,
-                (network.videos, network.cache_size, min_video_size))
-            for i in range(self.num_caches)]
-        self.caches = [result.get() for result in results]
-        mp_pool = None
+        with WorkerPool(network, processes, seed) as mp_pool:
+            results = [
+                mp_pool.apply_async(_random_cache_task, (min_video_size,))
+                for i in range(self.num_caches)]
+            self.caches = [result.get() for result in results]
 
 
 # ======================================================================
@@ -105,37 +219,266 @@ class CachingMonteCarlo(Caching):
         Caching.__init__(self, *args, **kwargs)
 
     # ----------------------------------------------------------
-    def fill(self, network, filepath=None, max_iter=int(1e10)):
+    def fill(
+            self,
+            network,
+            filepath=None,
+            max_iter=int(1e10),
+            batch_size=None,
+            processes=1,
+            seed=None,
+            stop_at_gap=None):
+        """
+        Sample random cachings, keeping the best.
+
+        Args:
+            network (Network): The network.
+            filepath (str): The output file.
+                If it exists, its score is the score to beat.
+                The best caching is saved to it when improved.
+            max_iter (int): The number of cachings to sample.
+            batch_size (int|None): The number of cachings per batch.
+                If None, the cachings are sampled one at a time.
+            processes (int|None): The number of worker processes.
+                If not 1, the batches are sampled on multiple processes.
+                If None, `multiprocessing.cpu_count()` is used.
+            seed (int|None): The seed for the random streams of the workers.
+            stop_at_gap (float|None): The gap at which to stop.
+                The run stops when the gap of the best score from the upper
+                bound is not larger than this (see `Network.gap()`).
+                If None, the gap is only reported.
+
+        Returns:
+            None.
+        """
         filename = os.path.basename(filepath)
         if os.path.isfile(filepath):
             curr_caching = Caching.load(filepath)
             curr_score = curr_caching.score(network)
-            print('montecarlo partial best - {:20s} SCORE: {}'.format(
-                filename, curr_score), flush=True)
+            # without improvements, the loaded caching is the result
+            self.caches = curr_caching.caches
+            print('montecarlo partial best - {:20s} SCORE: {}  gap={:.3%}'
+                  .format(filename, curr_score, network.gap(curr_score)),
+                  flush=True)
         else:
             curr_score = 0
+        if processes != 1:
+            self._fill_par(
+                network, filepath, max_iter, batch_size or 16, curr_score,
+                processes, seed, stop_at_gap)
+            return
+        elif batch_size:
+            self._fill_batch(
+                network, filepath, max_iter, batch_size, curr_score,
+                stop_at_gap)
+            return
+        stop_score = _stop_score(network, stop_at_gap)
         begin_time = datetime.datetime.now()
         j = 0
-        while j < max_iter:
+        while j < max_iter and curr_score < stop_score:
             min_video_size = np.min(network.videos)
-            self.caches = [
+            caching = Caching([
                 _random_cache(
                     network.videos, network.cache_size, min_video_size)
-                for i in range(self.num_caches)]
-            score = self.score(network)
+                for i in range(self.num_caches)])
+            score = caching.score(network)
             end_time = datetime.datetime.now()
-            print('montecarlo - {:20s} SCORE: {:7d}  ({})  j={}, t={}'.format(
-                filename, score, curr_score, j, end_time - begin_time),
-                flush=True)
+            print('montecarlo - {:20s} SCORE: {:7d}  ({})  gap={:.3%}, j={}, '
+                  't={}'.format(
+                    filename, score, curr_score, network.gap(curr_score), j,
+                    end_time - begin_time), flush=True)
             begin_time = end_time
             if score > curr_score:
                 curr_score = score
-                best_caches = self.caches
-                print('montecarlo partial best - {:20s} SCORE: {}'.format(
-                    filename, score), flush=True)
+                self.caches = caching.caches
+                print('montecarlo partial best - {:20s} SCORE: {}  gap={:.3%}'
+                      .format(filename, score, network.gap(score)), flush=True)
                 self.save(filepath)
             j += 1
 
+    # ----------------------------------------------------------
+    def _fill_batch(
+            self, network, filepath, max_iter, batch_size, curr_score,
+            stop_at_gap=None):
+        """
+        Sample random cachings in batches.
+
+        Args:
+            network (Network): The network.
+            filepath (str): The output file.
+            max_iter (int): The number of cachings to sample.
+            batch_size (int): The number of cachings per batch.
+            curr_score (int): The score to beat.
+            stop_at_gap (float|None): The gap at which to stop.
+
+        Returns:
+            None.
+        """
+        filename = os.path.basename(filepath)
+        bounds = _saving_bounds(network)
+        stop_score = _stop_score(network, stop_at_gap)
+        begin_time = datetime.datetime.now()
+        j = 0
+        while j < max_iter and curr_score < stop_score:
+            num = min(batch_size, max_iter - j)
+            score, placement, num_skipped = _montecarlo_batch(
+                network, num, curr_score, bounds)
+            end_time = datetime.datetime.now()
+            print('montecarlo - {:20s} SCORE: {:7d}  ({})  gap={:.3%}, j={}, '
+                  'skipped={}, t={}'.format(
+                    filename, score, curr_score, network.gap(curr_score), j,
+                    num_skipped, end_time - begin_time), flush=True)
+            begin_time = end_time
+            if score > curr_score:
+                curr_score = score
+                self.caches = CachingMatrix(placement).to_caching().caches
+                print('montecarlo partial best - {:20s} SCORE: {}  gap={:.3%}'
+                      .format(filename, score, network.gap(score)), flush=True)
+                self.save(filepath)
+            j += num
+
+    # ----------------------------------------------------------
+    def _fill_par(
+            self, network, filepath, max_iter, batch_size, curr_score,
+            processes, seed, stop_at_gap=None):
+        """
+        Sample random cachings in batches on multiple processes.
+
+        Each worker runs its own stream of batches, seeded from `seed` and
+        the stream index, so that a run is reproducible for a given number
+        of processes.
+        The best score is shared through shared memory, and only the worker
+        finding a new best writes the output file.
+
+        Args:
+            network (Network): The network.
+            filepath (str): The output file.
+            max_iter (int): The number of cachings to sample.
+            batch_size (int): The number of cachings per batch.
+            curr_score (int): The score to beat.
+            processes (int|None): The number of worker processes.
+                If None, `multiprocessing.cpu_count()` is used.
+            seed (int|None): The seed for the random streams.
+                If None, a random seed is used.
+            stop_at_gap (float|None): The gap at which to stop.
+                Each worker stops when the shared best score reaches it.
+
+        Returns:
+            None.
+        """
+        filename = os.path.basename(filepath)
+        if seed is None:
+            seed = random.randrange(2 ** 32)
+        begin_time = datetime.datetime.now()
+        with WorkerPool(network, processes) as mp_pool:
+            gains, max_gains = _saving_bounds(network)
+            handle, shared = mp_pool.share({
+                'best': np.array([curr_score], dtype=np.int64),
+                'gains': gains, 'max_gains': max_gains})
+            num_streams = mp_pool.processes
+            results = [
+                mp_pool.apply_async(
+                    _montecarlo_task,
+                    (handle, filepath, seed, i,
+                     max_iter // num_streams + (i < max_iter % num_streams),
+                     batch_size, stop_at_gap))
+                for i in range(num_streams)]
+            num_skipped = sum(result.get() for result in results)
+            best_score = int(shared['best'][0])
+        end_time = datetime.datetime.now()
+        print('montecarlo - {:20s} SCORE: {:7d}  gap={:.3%}, j={}, '
+              'skipped={}, t={}'.format(
+                filename, best_score, network.gap(best_score), max_iter,
+                num_skipped, end_time - begin_time), flush=True)
+        # otherwise, the caching loaded by `fill()` is kept
+        if best_score > curr_score:
+            self.caches = Caching.load(filepath).caches
+
+
+# ======================================================================
+def _montecarlo_batch(network, num, curr_score, bounds):
+    """
+    Sample and score a batch of random cachings.
+
+    Before scoring, a caching is skipped if an upper bound of its score
+    cannot beat `curr_score`.
+    The bound adds, for each video, the savings of each cache holding it
+    (as if the other caches were empty), but not more than the saving of
+    having the video in all caches.
+
+    Args:
+        network (Network): The network.
+        num (int): The number of cachings.
+        curr_score (int): The score to beat.
+        bounds (tuple[np.ndarray]): The saving bounds.
+            See `_saving_bounds()` for more info.
+
+    Returns:
+        result (tuple): The tuple contains:
+            - score (int): The best score in the batch (0 if all skipped).
+            - placement (np.ndarray|None): The best placement.
+            - num_skipped (int): The number of skipped cachings.
+    """
+    num_caches, num_videos = network.num_caches, network.num_videos
+    gains, max_gains = bounds
+    num_tot = int(np.sum(network.req_count, dtype=np.int64))
+    draws, taken = _random_draws(
+        num * num_caches, network.videos, network.cache_size)
+    candidates = np.repeat(np.arange(num), num_caches)[:, None]
+    caches = np.tile(np.arange(num_caches), num)[:, None]
+    # upper bound
+    video_gains = np.bincount(
+        (candidates * num_videos + draws)[taken],
+        gains[caches, draws][taken],
+        minlength=num * num_videos).reshape(num, num_videos)
+    upper_bounds = np.sum(np.minimum(video_gains, max_gains), axis=1)
+    promising = np.flatnonzero(upper_bounds / num_tot * 1000 >= curr_score + 1)
+    if not len(promising):
+        return 0, None, num
+    # full scoring
+    placements = np.zeros(
+        (len(promising), num_caches, num_videos), dtype=bool)
+    rows = np.searchsorted(promising, candidates[:, 0])
+    mask = np.isin(candidates[:, 0], promising)[:, None] & taken
+    placements[
+        np.broadcast_to(rows[:, None], draws.shape)[mask],
+        np.broadcast_to(caches, draws.shape)[mask], draws[mask]] = True
+    scores = network.score_placement(placements)
+    i = int(np.argmax(scores))
+    return int(scores[i]), placements[i], num - len(promising)
+
+
+# ======================================================================
+def _montecarlo_task(
+        handle, filepath, seed, stream, max_iter, batch_size,
+        stop_at_gap=None):
+    # runs in a `WorkerPool` worker: one reproducible stream of batches
+    network = worker_network()
+    stop_score = _stop_score(network, stop_at_gap)
+    shared = attach_arrays(handle)
+    best = shared['best']
+    bounds = shared['gains'], shared['max_gains']
+    np.random.seed(np.random.SeedSequence([seed, stream]).generate_state(4))
+    filename = os.path.basename(filepath)
+    num_skipped = 0
+    j = 0
+    while j < max_iter and best[0] < stop_score:
+        num = min(batch_size, max_iter - j)
+        score, placement, num_batch_skipped = _montecarlo_batch(
+            network, num, int(best[0]), bounds)
+        num_skipped += num_batch_skipped
+        if score > best[0]:
+            with worker_lock():
+                if score > best[0]:
+                    best[0] = score
+                    CachingMatrix(placement).save(filepath)
+                    print('montecarlo partial best - {:20s} SCORE: {}  '
+                          'gap={:.3%}  (stream={})'.format(
+                            filename, score, network.gap(score), stream),
+                          flush=True)
+        j += num
+    return num_skipped
+
 
 # ======================================================================
 class CachingBruteForce(Caching):
@@ -143,35 +486,308 @@ class CachingBruteForce(Caching):
         Caching.__init__(self, *args, **kwargs)
 
     # ----------------------------------------------------------
-    def fill(self, network, filepath=None):
-        print('Working on `{}`'.format(filepath), flush=True)
-        filename = os.path.basename(filepath)
-        max_videos = np.sum(
-            np.cumsum(np.sort(network.videos)) < network.cache_size)
-        print('max num videos: {}'.format(max_videos), flush=True)
-        possible_caches = []
-        for uncut_cache in \
-                itertools.combinations(range(network.num_videos), max_videos):
-            cut_size = np.sum(
-                np.cumsum([network.videos[i]
-                           for i in uncut_cache]) < network.cache_size)
-            possible_caches.append(uncut_cache[:cut_size])
-        print('num caches poss.: {}'.format(len(possible_caches)), flush=True)
-        curr_score = 0
-        best_caches = None
-        for caches in \
-                itertools.combinations(possible_caches, network.num_caches):
-            self.caches = caches
-            score = self.score(network)
-            print('bruteforce partial - {:20s} SCORE: {}'.format(
-                filename, score), flush=True)
-            if score > curr_score:
-                curr_score = score
-                best_caches = caches
-                print('bruteforce partial best - {:20s} SCORE: {}'.format(
-                    filename, score), flush=True)
-                self.save(filepath)
-        self.caches = best_caches
+    def fill(
+            self,
+            network,
+            filepath=None,
+            max_time=None,
+            save_interval=10.0,
+            stop_at_gap=None):
+        """
+        Find the optimal caching by branch and bound.
+
+        The (cache, video) decisions are explored depth-first, one cache at
+        a time, trying to add each video before skipping it.
+        A branch is pruned when the current saving plus an upper bound of
+        the remaining gain cannot beat the best saving.
+        The bound is the sum over the caches of the fractional knapsack
+        of the current gains of the undecided videos: since adding videos
+        never increases the gains of the others, this is never exceeded.
+        Only the current branch is kept in memory.
+        The search starts from the best of `filepath` (if it exists) and of
+        `CachingGreedyGain`.
+
+        Args:
+            network (Network): The network.
+            filepath (str|None): The output file.
+                The best caching is saved to it when improved (at most every
+                `save_interval` seconds) and at the end.
+            max_time (float|None): The time budget in seconds.
+                If None, search until optimality is proven.
+            save_interval (float): The minimum time between saves in s.
+            stop_at_gap (float|None): The gap at which to stop.
+                The search stops when the gap of the best score from the
+                upper bound is not larger than this (see `Network.gap()`).
+                If None, the gap is only reported.
+
+        Returns:
+            None.
+        """
+        filename = os.path.basename(filepath) if filepath else ''
+        greedy = CachingGreedyGain(network.num_caches)
+        greedy.fill(network)
+        best = CachingMatrix(greedy.caches, network.num_videos).placement
+        if filepath and os.path.isfile(filepath):
+            caching = Caching.load(filepath)
+            if len(caching.caches) == network.num_caches and \
+                    caching.validate(network.videos, network.cache_size):
+                placement = _placement(caching, network.num_videos)
+                if network.score_placement(placement) > \
+                        network.score_placement(best):
+                    best = placement
+        best_saving = int(network.savings(best)[0])
+        best_score = network.score_placement(best)
+        print('bruteforce partial best - {:20s} SCORE: {}  gap={:.3%}'.format(
+            filename, best_score, network.gap(best_score)), flush=True)
+
+        evaluator = Evaluator(network)
+        sizes = evaluator.sizes
+        gains = evaluator.gains()
+        # decisions: cache by cache, by decreasing gain per unit size
+        feasible = (gains > 0) & (sizes <= network.cache_size)
+        decisions = np.lexsort(
+            (-(gains / sizes).ravel(),
+             np.repeat(np.arange(network.num_caches), network.num_videos)))
+        decisions = decisions[feasible.ravel()[decisions]]
+        caches, videos = np.divmod(decisions, network.num_videos)
+        num_decisions = len(decisions)
+
+        stop_time = time.time() + max_time if max_time is not None else None
+        stop_score = _stop_score(network, stop_at_gap)
+        last_time = time.time()
+        last_saving = best_saving
+        begin_time = datetime.datetime.now()
+        num_nodes = 0
+        # each frame is (decision, branch): 0 to enter, 1 after adding
+        stack = [(0, 0)]
+        while stack and best_score < stop_score:
+            k, branch = stack.pop()
+            if branch == 1:
+                # backtrack, then skip the video
+                evaluator.apply(caches[k], videos[k], False)
+                gains[:, videos[k]] = evaluator.video_gains(videos[k])
+                stack.append((k + 1, 0))
+                continue
+            num_nodes += 1
+            if evaluator.saving > best_saving:
+                best_saving = evaluator.saving
+                best_score = evaluator.score
+                best = evaluator.placement.copy()
+            if k == num_decisions or _bound(
+                    gains, sizes, evaluator.free, caches[k:], videos[k:]) + \
+                    evaluator.saving < best_saving + 1:
+                continue
+            cache, video = caches[k], videos[k]
+            if gains[cache, video] > 0 and evaluator.fits(cache, video):
+                evaluator.apply(cache, video, True)
+                gains[:, video] = evaluator.video_gains(video)
+                stack.append((k, 1))
+            stack.append((k + 1, 0))
+            if best_saving > last_saving and \
+                    time.time() - last_time >= save_interval:
+                self._save_best(
+                    network, best, filepath, filename, num_nodes, begin_time)
+                last_saving = best_saving
+                last_time = time.time()
+            if stop_time is not None and time.time() >= stop_time:
+                break
+        print('bruteforce - {:20s} {}, nodes={}'.format(
+            filename, 'optimal' if not stack else 'stopped', num_nodes),
+            flush=True)
+        self._save_best(
+            network, best, filepath, filename, num_nodes, begin_time)
+        self.caches = CachingMatrix(best).to_caching().caches
+
+    # ----------------------------------------------------------
+    def _save_best(
+            self, network, placement, filepath, filename, num_nodes,
+            begin_time):
+        end_time = datetime.datetime.now()
+        score = network.score_placement(placement)
+        print('bruteforce partial best - {:20s} SCORE: {}  gap={:.3%}, '
+              'nodes={}, t={}'.format(
+                filename, score, network.gap(score), num_nodes,
+                end_time - begin_time), flush=True)
+        if filepath:
+            CachingMatrix(placement).save(filepath)
+
+
+# ======================================================================
+def _bound(gains, sizes, free, caches, videos):
+    # sum over the caches of the fractional knapsack of the gains
+    gains = gains[caches, videos]
+    mask = gains > 0
+    gains, sizes, caches = gains[mask], sizes[videos[mask]], caches[mask]
+    if not len(gains):
+        return 0
+    order = np.lexsort((-gains / sizes, caches))
+    gains, sizes, caches = gains[order], sizes[order], caches[order]
+    ends = np.cumsum(sizes)
+    starts = ends - sizes
+    firsts = np.flatnonzero(np.diff(caches, prepend=-1))
+    starts -= np.repeat(starts[firsts], np.diff(np.append(firsts, len(caches))))
+    fractions = np.clip((free[caches] - starts) / sizes, 0, 1)
+    return np.sum(gains * fractions)
+
+
+# ======================================================================
+class EvolutionCheckpoint(object):
+    def __init__(
+            self,
+            filepath,
+            interval=60.0,
+            export_dirpath=None):
+        """
+        Checkpoint store for evolution runs.
+
+        The population (packed placements and scores) and the run metadata
+        are saved to a single compressed `.npz` file.
+        Writes happen on a background thread and are atomic (the file is
+        written to a temporary file which then replaces the old one).
+        Only the latest submitted state is written.
+        The latest state is always written on `close()` (also when leaving
+        the `with` block, e.g. on an interrupt), even if it was submitted
+        within the interval.
+
+        Args:
+            filepath (str): The checkpoint file.
+            interval (float): The minimum time between writes in s.
+            export_dirpath (str|None): The directory for the export.
+                If not None, each individual is also written as an output
+                file in this directory (the legacy per-file layout).
+        """
+        self.filepath = filepath
+        self.interval = interval
+        self.export_dirpath = export_dirpath
+        self._last_time = None
+        self._latest = None
+        self._pending = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    # ----------------------------------------------------------
+    def __enter__(self):
+        return self
+
+    # ----------------------------------------------------------
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # ----------------------------------------------------------
+    def submit(self, population, scores, meta, force=False):
+        """
+        Submit a state for writing.
+
+        The arrays are not copied, and must not be modified afterwards.
+
+        Args:
+            population (np.ndarray): The packed placements.
+            scores (np.ndarray): The scores.
+            meta (dict): The run metadata (JSON-serializable).
+            force (bool): Write regardless of the interval.
+
+        Returns:
+            submitted (bool): True if the state was queued for writing.
+                Otherwise, it is kept until the next submission or until
+                `close()`.
+        """
+        now = time.time()
+        if not force and self._last_time is not None and \
+                now - self._last_time < self.interval:
+            self._latest = (population, scores, meta)
+            return False
+        self._last_time = now
+        with self._condition:
+            self._latest = None
+            self._pending = (population, scores, meta)
+            self._condition.notify()
+        return True
+
+    # ----------------------------------------------------------
+    def close(self):
+        """
+        Write the latest state and stop the background thread.
+
+        Returns:
+            None.
+        """
+        with self._condition:
+            if self._latest is not None:
+                self._pending, self._latest = self._latest, None
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    # ----------------------------------------------------------
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None and not self._closed:
+                    self._condition.wait()
+                if self._pending is None:
+                    return
+                state, self._pending = self._pending, None
+            try:
+                self._write(*state)
+            except Exception as e:
+                print('E: Checkpoint `{}` failed: {}'.format(
+                    self.filepath, e), flush=True)
+
+    # ----------------------------------------------------------
+    def _write(self, population, scores, meta):
+        tmp_filepath = self.filepath + '.tmp'
+        with open(tmp_filepath, 'wb') as file:
+            np.savez_compressed(
+                file, population=population, scores=scores,
+                meta=np.array(json.dumps(meta)))
+        os.replace(tmp_filepath, self.filepath)
+        if self.export_dirpath:
+            _export_population(
+                self.export_dirpath, population, scores, meta)
+
+    # ----------------------------------------------------------
+    @staticmethod
+    def load(filepath):
+        """
+        Load a checkpoint.
+
+        Args:
+            filepath (str): The checkpoint file.
+
+        Returns:
+            result (tuple|None): The tuple contains:
+                - population (np.ndarray): The packed placements.
+                - scores (np.ndarray): The scores.
+                - meta (dict): The run metadata.
+                If the file does not exist, None is returned.
+        """
+        if not os.path.isfile(filepath):
+            return None
+        with np.load(filepath) as data:
+            return (
+                data['population'], data['scores'],
+                json.loads(str(data['meta'])))
+
+
+# ======================================================================
+def _export_population(dirpath, population, scores, meta):
+    # write each individual to a new directory, then swap it in
+    tmp_dirpath = dirpath + '.tmp'
+    old_dirpath = os.path.join(
+        os.path.dirname(dirpath), '_old_' + os.path.basename(dirpath))
+    shutil.rmtree(tmp_dirpath, ignore_errors=True)
+    os.makedirs(tmp_dirpath)
+    for i, (score, individual) in enumerate(zip(scores, population)):
+        CachingMatrix.from_packed(individual, meta['num_videos']).save(
+            os.path.join(tmp_dirpath, '{:07d}_id{:04d}_gen{:06d}__'.format(
+                int(score), i, meta['generation']) + meta['filename']))
+    shutil.rmtree(old_dirpath, ignore_errors=True)
+    if os.path.isdir(dirpath):
+        os.rename(dirpath, old_dirpath)
+    os.rename(tmp_dirpath, dirpath)
+    shutil.rmtree(old_dirpath, ignore_errors=True)
 
 
 # ======================================================================
@@ -191,16 +807,57 @@ class CachingEvolution(Caching):
             mutation_rate=0.05,
             mutation=0.1,
             elitism=0.005,
-            multiproc=True):
+            multiproc=True,
+            processes=None,
+            checkpoint_interval=60.0,
+            export=False,
+            stop_at_gap=None):
+        """
+        Evolve a population of cachings with a genetic algorithm.
+
+        The run state is kept in the `<basename>.evo.npz` checkpoint next to
+        `filepath` (see `EvolutionCheckpoint`), and is resumed from it.
+        A population in the legacy per-file layout (the `<basename>`
+        directory) is also resumed.
+        The best caching is saved to `filepath` when improved.
+
+        Args:
+            network (Network): The network.
+            filepath (str): The output file.
+            max_generations (int): The number of generations to run.
+            pool_size (int): The number of individuals.
+            selection (float): The fraction of individuals used as parents.
+            crossover (float): The fraction of caches from the best parent.
+            mutation_rate (float): The fraction of offspring not mutated.
+            mutation (float): The fraction of caches mutated.
+            elitism (float): The fraction of individuals kept.
+            multiproc (bool): Score the offspring on multiple processes.
+            processes (int|None): The number of worker processes.
+                If None, `multiprocessing.cpu_count()` is used.
+            checkpoint_interval (float): The minimum time between
+                checkpoints in s.
+            export (bool): Also export the population in the per-file layout.
+            stop_at_gap (float|None): The gap at which to stop.
+                The run stops when the gap of the best score from the upper
+                bound is not larger than this (see `Network.gap()`).
+                If None, the gap is only reported.
+
+        Returns:
+            None.
+        """
         dirpath = os.path.dirname(filepath)
         filename = os.path.basename(filepath)
         basename = os.path.splitext(filename)[0]
         evo_dirpath = os.path.join(dirpath, basename)
         old_evo_dirpath = os.path.join(dirpath, '_old_' + basename)
+        checkpoint_filepath = os.path.join(dirpath, basename + '.evo.npz')
 
-        if not os.path.isdir(evo_dirpath):
-            os.makedirs(evo_dirpath)
-
+        num_caches, num_videos = network.num_caches, network.num_videos
+        num_bytes = (num_videos + 7) // 8
+        state = EvolutionCheckpoint.load(checkpoint_filepath)
+        if state is not None and \
+                state[0].shape != (pool_size, num_caches, num_bytes):
+            state = None
         pool_filenames, pool_dirpath = [], ''
         if os.path.isdir(evo_dirpath):
             pool_filenames = os.listdir(evo_dirpath)
@@ -208,84 +865,135 @@ class CachingEvolution(Caching):
         if len(pool_filenames) != pool_size and os.path.isdir(old_evo_dirpath):
             pool_filenames = os.listdir(old_evo_dirpath)
             pool_dirpath = old_evo_dirpath
-        if len(pool_filenames) != pool_size:
-            pool = []
-            if os.path.isfile(filepath):
-                caching = Caching.load(filepath)
-                pool.append((caching.score(network), caching))
-            for _ in range(pool_size - len(pool)):
-                caching = Caching(network.num_caches)
-                caching.fill(network)
-                pool.append((caching.score(network), caching))
-        else:
-            pool = [
-                (int(name.split('_')[0]),
-                 Caching.load(os.path.join(pool_dirpath, name)))
-                for name in pool_filenames]
 
-        pool = sorted(pool, key=operator.itemgetter(0), reverse=True)
+        pool = WorkerPool(network, processes) if multiproc \
+            else contextlib.nullcontext()
+        with pool as mp_pool, EvolutionCheckpoint(
+                checkpoint_filepath, checkpoint_interval,
+                evo_dirpath if export else None) as checkpoint:
+            shared = None
+            if mp_pool is not None:
+                handle, buffers = mp_pool.share({
+                    'population': np.zeros(
+                        (pool_size, num_caches, num_bytes), dtype=np.uint8)})
+                shared = handle, buffers['population']
 
-        begin_time = datetime.datetime.now()
-        generation = 0
-        best_score = pool[0][0]
-        mp_pool = multiprocessing.Pool(multiprocessing.cpu_count()) \
-            if multiproc else None
-        while generation < max_generations:
-            # selection
-            selected = pool[:int(pool_size * selection)]
-
-            # elitism
-            elite = copy.deepcopy(pool[:int(pool_size * elitism) + 1])
-
-            # crossover and mutate
-            num_generators = 2
-
-            if multiproc:
-                results = [
-                    mp_pool.apply_async(
-                        _breeding,
-                        ([selected[i] for i in sorted(random.sample(
-                            range(len(selected)), num_generators))],
-                         network, crossover, mutation_rate, mutation))
-                    for _ in range(pool_size - len(elite))]
-                offspring = [result.get() for result in results]
+            # the population is kept as packed placements
+            generation = 0
+            if state is not None:
+                population, scores, meta = state
+                generation = meta['generation'] + 1
+            elif len(pool_filenames) != pool_size:
+                cachings = []
+                if os.path.isfile(filepath):
+                    cachings.append(Caching.load(filepath))
+                population = np.zeros(
+                    (pool_size, num_caches, num_bytes), dtype=np.uint8)
+                for i, caching in enumerate(cachings):
+                    population[i] = np.packbits(
+                        _placement(caching, num_videos), axis=-1)
+                # same random content in all caches (as in `Caching.fill()`)
+                population[len(cachings):] = np.packbits(_random_placements(
+                    pool_size - len(cachings), network.videos,
+                    network.cache_size), axis=-1)[:, None, :]
+                scores = _population_scores(
+                    population, network, mp_pool, shared)
             else:
-                offspring = [
-                    _breeding([selected[i] for i in sorted(random.sample(
-                        range(len(selected)), num_generators))], network,
-                              crossover, mutation_rate, mutation)
-                    for _ in range(pool_size - len(elite))]
-            pool = elite + offspring
-
-            # delete old generation
-            if os.path.isdir(old_evo_dirpath):
-                shutil.rmtree(old_evo_dirpath, ignore_errors=True)
-                shutil.rmtree(old_evo_dirpath, ignore_errors=True)
-            shutil.move(evo_dirpath, old_evo_dirpath)
-            os.makedirs(evo_dirpath)
-
-            # save new generation
-            pool = sorted(pool, key=operator.itemgetter(0), reverse=True)
-            [caching.save(
-                os.path.join(evo_dirpath,
-                             '{:07d}_id{:04d}_gen{:06d}__'.format(
-                                 score, i, generation) + filename))
-             for i, (score, caching) in enumerate(pool)]
-
-            if pool[0][0] > best_score:
-                pool[0][1].save(filepath)
-                best_score = pool[0][0]
+                scores = np.array(
+                    [int(name.split('_')[0]) for name in pool_filenames])
+                population = np.stack([
+                    np.packbits(_placement(
+                        Caching.load(os.path.join(pool_dirpath, name)),
+                        num_videos), axis=-1)
+                    for name in pool_filenames])
 
-            end_time = datetime.datetime.now()
-            print('evolution - {:20s} SCORE: {:7d}, gen={}, t={}'.format(
-                filename, best_score, generation, end_time - begin_time),
-                flush=True)
-            begin_time = end_time
+            # resumed individuals may not fit (e.g. edited files): repair them
+            invalid = np.flatnonzero(np.any(overflows(
+                population, network.videos, network.cache_size), axis=-1))
+            if len(invalid):
+                print('W: Repairing {} invalid individuals'.format(
+                    len(invalid)))
+                repaired = population[invalid]
+                scores[invalid] = _population_scores(repaired, network)
+                population[invalid] = repaired
+
+            order = np.argsort(-scores, kind='stable')
+            population, scores = population[order], scores[order]
+
+            meta = dict(
+                filename=filename, pool_size=pool_size, num_caches=num_caches,
+                num_videos=num_videos)
+            begin_time = datetime.datetime.now()
+            last_generation = generation + max_generations
+            stop_score = _stop_score(network, stop_at_gap)
+            best_score = scores[0]
+            num_selected = max(int(pool_size * selection), 2)
+            num_elite = int(pool_size * elitism) + 1
+            num_offspring = pool_size - num_elite
+            num_crossed = int(num_caches * (1 - crossover))
+            num_mutated = int(num_caches * mutation)
+            rows = np.arange(num_offspring)[:, None]
+            while generation < last_generation and best_score < stop_score:
+                # selection: two different parents, the best one is the base
+                first = np.random.randint(num_selected, size=num_offspring)
+                second = np.random.randint(
+                    num_selected - 1, size=num_offspring)
+                second += second >= first
+                offspring = population[np.minimum(first, second)]
+                other = np.maximum(first, second)[:, None]
+
+                # crossover: caches from the other parent
+                if num_crossed:
+                    crossed = np.argpartition(
+                        np.random.random((num_offspring, num_caches)),
+                        num_crossed - 1, axis=1)[:, :num_crossed]
+                    offspring[rows, crossed] = population[other, crossed]
+
+                # mutation: caches with random content
+                mutants = np.flatnonzero(
+                    np.random.random(num_offspring) >= mutation_rate)
+                if num_mutated and len(mutants):
+                    mutated = np.argpartition(
+                        np.random.random((len(mutants), num_caches)),
+                        num_mutated - 1, axis=1)[:, :num_mutated]
+                    offspring[mutants[:, None], mutated] = np.packbits(
+                        _random_placements(
+                            len(mutants) * num_mutated, network.videos,
+                            network.cache_size),
+                        axis=-1).reshape(len(mutants), num_mutated, -1)
+
+                # repair and score; elitism
+                offspring_scores = _population_scores(
+                    offspring, network, mp_pool, shared)
+                _check_population(offspring, network)
+                population = np.concatenate(
+                    [population[:num_elite], offspring])
+                scores = np.concatenate(
+                    [scores[:num_elite], offspring_scores])
+                order = np.argsort(-scores, kind='stable')
+                population, scores = population[order], scores[order]
+
+                if scores[0] > best_score:
+                    CachingMatrix.from_packed(population[0], num_videos).save(
+                        filepath)
+                    best_score = scores[0]
+
+                # the latest state is written on leaving, also on interrupts
+                meta.update(generation=generation, best_score=int(best_score))
+                checkpoint.submit(population, scores, meta.copy())
+
+                end_time = datetime.datetime.now()
+                print('evolution - {:20s} SCORE: {:7d}, gap={:.3%}, gen={}, '
+                      't={}'.format(
+                        filename, best_score, network.gap(best_score),
+                        generation, end_time - begin_time), flush=True)
+                begin_time = end_time
 
-            generation += 1
+                generation += 1
 
         # return best result
-        self.caches = pool[0][1].caches
+        self.caches = CachingMatrix.from_packed(
+            population[0], num_videos).to_caching().caches
 
 
 # ======================================================================
@@ -295,30 +1003,31 @@ class CachingOptimByRequests(Caching):
 
     # ----------------------------------------------------------
     def fill(self, network):
-        # sort requests by number of requests divided by video size
-        sorted_requests = sorted(
-            network.requests,
-            key=lambda x: x[2] / network.videos[x[1]], reverse=True)
-        # key=lambda x: x[2])[::-1]
-        # min_video_size = np.min(network.videos)
-        free_caches = np.ones(network.num_caches) * network.cache_size
-        cached_requests = []
-        for request in sorted_requests:
-            if request not in cached_requests:
-                new_video, endpoint, num = request
-                # sorted_caches = np.argsort(
-                #     network.cache_latencies[endpoint, :])
-                sorted_caches = np.argsort(
-                    network.cache_latencies[endpoint, :] / (free_caches + 1))
-                sorted_caches = sorted_caches[
-                    network.cache_latencies[endpoint, :] > 0]
-                for i in list(sorted_caches):
-                    video_size = network.videos[new_video]
-                    if (video_size <= free_caches[i] and
-                                new_video not in self.caches[i]):
-                        self.caches[i].add(new_video)
-                        free_caches[i] -= video_size
-                        cached_requests.append(request)
+        """
+        Add the most requested videos to the caches of their endpoints.
+
+        The requests are visited by decreasing number of requests divided
+        by video size (see `_sorted_requests()`), and the video of each
+        request is added to all the caches connected to its endpoint that
+        have room for it.
+        Since each video only uses the free space of its own cache, the
+        order of the caches of an endpoint does not change the result,
+        and the connections are visited in their stored order.
+
+        Args:
+            network (Network): The network.
+
+        Returns:
+            None.
+        """
+        placement = _placement(self, network.num_videos).copy()
+        free = np.full(network.num_caches, network.cache_size, dtype=np.int64)
+        order = _sorted_requests(network)
+        _fill_by_requests(
+            placement, free, network.videos, network.req_video[order],
+            network.req_endpoint[order], network.link_offsets,
+            network.link_caches)
+        self.caches = CachingMatrix(placement).to_caching().caches
 
 
 # ======================================================================
@@ -328,23 +1037,580 @@ class CachingOptimByCaches(Caching):
 
     # ----------------------------------------------------------
     def fill(self, network):
-        # sort requests by number of requests divided by video size
-        sorted_requests = sorted(
-            network.requests,
-            key=lambda x: x[2] / network.videos[x[1]], reverse=True)
-        # key=lambda x: x[2])[::-1]
-        min_video_size = np.min(network.videos)
-        free_caches = np.ones(network.num_caches) * network.cache_size
-        cached_requests = []
-        for i, cache in enumerate(self.caches):
-            for request in sorted_requests:
-                if request not in cached_requests:
-                    new_video, endpoint, num = request
-                    video_size = network.videos[new_video]
-                    if (video_size <= free_caches[i] and
-                                new_video not in cache):
-                        cache.add(new_video)
-                        free_caches[i] -= video_size
-                        cached_requests.append(request)
-                if free_caches[i] < min_video_size:
+        """
+        Fill the caches one at a time with the most requested videos.
+
+        The requests are visited by decreasing number of requests divided
+        by video size (see `_sorted_requests()`), and the video of each
+        request is added to the current cache if it has room for it.
+        A request whose video was added to a cache is not used again for
+        the following caches (identical requests count as one).
+
+        Args:
+            network (Network): The network.
+
+        Returns:
+            None.
+        """
+        placement = _placement(self, network.num_videos).copy()
+        free = np.full(network.num_caches, network.cache_size, dtype=np.int64)
+        order = _sorted_requests(network)
+        _, keys = np.unique(
+            np.stack([
+                network.req_video, network.req_endpoint, network.req_count],
+                axis=1),
+            axis=0, return_inverse=True)
+        _fill_by_caches(
+            placement, free, network.videos, network.req_video[order],
+            keys.ravel()[order], np.min(network.videos))
+        self.caches = CachingMatrix(placement).to_caching().caches
+
+
+# ======================================================================
+def _sorted_requests(network):
+    # requests by decreasing number of requests divided by the size of the
+    # video indexed by the endpoint (as originally ranked), ties kept in order
+    ratios = network.req_count / network.videos[network.req_endpoint]
+    return np.argsort(-ratios, kind='stable')
+
+
+# ======================================================================
+@njit(nogil=True, cache=True)
+def _fill_by_requests(
+        placement, free, sizes, req_video, req_endpoint, link_offsets,
+        link_caches):
+    for i in range(len(req_video)):
+        video = req_video[i]
+        endpoint = req_endpoint[i]
+        for j in range(link_offsets[endpoint], link_offsets[endpoint + 1]):
+            cache = link_caches[j]
+            if not placement[cache, video] and sizes[video] <= free[cache]:
+                placement[cache, video] = True
+                free[cache] -= sizes[video]
+
+
+# ======================================================================
+@njit(nogil=True, cache=True)
+def _fill_by_caches(placement, free, sizes, req_video, req_keys, min_size):
+    cached = np.zeros(len(req_keys), dtype=np.bool_)
+    for cache in range(len(free)):
+        for i in range(len(req_video)):
+            video = req_video[i]
+            if not cached[req_keys[i]] and not placement[cache, video] \
+                    and sizes[video] <= free[cache]:
+                placement[cache, video] = True
+                free[cache] -= sizes[video]
+                cached[req_keys[i]] = True
+            if free[cache] < min_size:
+                break
+
+
+# ======================================================================
+class CachingGreedyGain(Caching):
+    def __init__(self, *args, **kwargs):
+        Caching.__init__(self, *args, **kwargs)
+
+    # ----------------------------------------------------------
+    def fill(self, network):
+        """
+        Add the videos with the largest score gain per unit size first.
+
+        All feasible (cache, video) pairs are kept in a max-heap of their
+        gain divided by the video size.
+        Adding a video to a cache only changes the gains of the same video
+        in the other caches: these are updated after each insertion, and the
+        heap entries are lazily re-evaluated when popped (CELF).
+        Any videos already in the caches are kept.
+
+        Args:
+            network (Network): The network.
+
+        Returns:
+            None.
+        """
+        evaluator = Evaluator(network, self)
+        sizes = evaluator.sizes
+        gains = evaluator.gains()
+        caches, videos = np.nonzero(
+            (gains > 0) & (sizes <= evaluator.free[:, None]))
+        heap = list(zip(
+            (-gains[caches, videos] / sizes[videos]).tolist(),
+            caches.tolist(), videos.tolist(), gains[caches, videos].tolist()))
+        heapq.heapify(heap)
+        while heap:
+            ratio, cache, video, gain = heapq.heappop(heap)
+            if not evaluator.fits(cache, video):
+                # free space only decreases: drop the pair
+                continue
+            if gain != gains[cache, video]:
+                gain = int(gains[cache, video])
+                if gain > 0:
+                    heapq.heappush(
+                        heap, (-gain / sizes[video], cache, video, gain))
+            else:
+                evaluator.apply(cache, video)
+                gains[:, video] = evaluator.video_gains(video)
+
+
+# ======================================================================
+def _cache_groups(network):
+    # greedily group the caches that share no endpoints
+    groups, group_endpoints = [], []
+    for cache in range(network.num_caches):
+        endpoints = set(
+            network.link_endpoints[network.link_caches == cache].tolist())
+        for group, used in zip(groups, group_endpoints):
+            if not used & endpoints:
+                group.append(cache)
+                used |= endpoints
+                break
+        else:
+            groups.append([cache])
+            group_endpoints.append(endpoints)
+    return groups
+
+
+# ======================================================================
+def _knapsack_task(cache, gains, max_capacity):
+    network = worker_network()
+    return cache, knapsack(
+        gains, network.videos, network.cache_size, max_capacity)
+
+
+# ======================================================================
+class CachingBlockAscent(Caching):
+    def __init__(self, *args, **kwargs):
+        Caching.__init__(self, *args, **kwargs)
+
+    # ----------------------------------------------------------
+    def fill(
+            self,
+            network,
+            filepath=None,
+            max_sweeps=None,
+            max_capacity=None,
+            processes=1,
+            stop_at_gap=None):
+        """
+        Re-optimize the content of one cache at a time.
+
+        The content of each cache is replaced by the solution of the
+        knapsack problem with the savings of the videos given the other
+        caches, until a full sweep over the caches does not improve.
+        Caches that share no endpoints do not affect each other, so their
+        knapsack problems are solved together, on multiple processes.
+
+        Args:
+            network (Network): The network.
+            filepath (str|None): The output file.
+                If it exists, it is used as the starting point.
+                Otherwise, the current caches are used (if all empty, these
+                are first filled at random).
+                After each improving sweep, the result is saved to it.
+            max_sweeps (int|None): The maximum number of sweeps.
+                If None, iterate until convergence.
+            max_capacity (int|None): The maximum capacity of the table.
+                See `knapsack()` for more info.
+            processes (int|None): The number of worker processes.
+                If 1, the knapsack problems are solved in this process.
+                If None, `multiprocessing.cpu_count()` is used.
+            stop_at_gap (float|None): The gap at which to stop.
+                The run stops when the gap of the best score from the upper
+                bound is not larger than this (see `Network.gap()`).
+                If None, the gap is only reported.
+
+        Returns:
+            None.
+        """
+        filename = os.path.basename(filepath) if filepath else ''
+        if filepath and os.path.isfile(filepath):
+            self.caches = Caching.load(filepath).caches
+        elif not any(self.caches):
+            Caching.fill(self, network)
+        evaluator = Evaluator(network, self)
+        groups = _cache_groups(network)
+        stop_score = _stop_score(network, stop_at_gap)
+        begin_time = datetime.datetime.now()
+        sweep = 0
+        improved = evaluator.score < stop_score
+        pool = WorkerPool(network, processes) if processes != 1 \
+            else contextlib.nullcontext()
+        with pool as mp_pool:
+            while improved and (max_sweeps is None or sweep < max_sweeps):
+                improved = False
+                for group in groups:
+                    gains = {
+                        cache: evaluator.cache_gains(cache)
+                        for cache in group}
+                    if mp_pool is not None and len(group) > 1:
+                        results = [
+                            mp_pool.apply_async(
+                                _knapsack_task,
+                                (cache, gains[cache], max_capacity))
+                            for cache in group]
+                        results = [result.get() for result in results]
+                    else:
+                        results = [
+                            (cache, knapsack(
+                                gains[cache], network.videos,
+                                network.cache_size, max_capacity))
+                            for cache in group]
+                    for cache, videos in results:
+                        old_videos = np.flatnonzero(evaluator.placement[cache])
+                        if np.sum(gains[cache][videos]) > \
+                                np.sum(gains[cache][old_videos]):
+                            for video in np.setdiff1d(old_videos, videos):
+                                evaluator.apply(cache, video, False)
+                            for video in np.setdiff1d(videos, old_videos):
+                                evaluator.apply(cache, video, True)
+                            improved = True
+                end_time = datetime.datetime.now()
+                print('block ascent - {:20s} SCORE: {:7d}, gap={:.3%}, '
+                      'sweep={}, t={}'.format(
+                        filename, evaluator.score,
+                        network.gap(evaluator.score), sweep,
+                        end_time - begin_time), flush=True)
+                begin_time = end_time
+                if improved and filepath:
+                    self.save(filepath)
+                if evaluator.score >= stop_score:
                     break
+                sweep += 1
+
+
+# ======================================================================
+def _local_move(gains, held, sizes, free, strategy='first'):
+    # gains: the savings of the videos in the cache given the other caches
+    # candidates for addition, by decreasing saving per unit size
+    candidates = np.flatnonzero(~held & (gains > 0))
+    candidates = candidates[
+        np.argsort(-gains[candidates] / sizes[candidates], kind='stable')]
+    moves = []
+    # add: a single video that fits
+    fitting = candidates[sizes[candidates] <= free]
+    if len(fitting):
+        video = fitting[np.argmax(gains[fitting])] \
+            if strategy == 'best' else fitting[0]
+        moves.append((gains[video], [], [video]))
+        if strategy == 'first':
+            return moves[0]
+    # swap: one video for the best single video or the densest videos
+    held_videos = np.flatnonzero(held)
+    if len(held_videos) and len(candidates):
+        budgets = free + sizes[held_videos]
+        losses = gains[held_videos]
+        # densest videos
+        cum_sizes = np.cumsum(sizes[candidates])
+        cum_gains = np.cumsum(gains[candidates])
+        num_dense = np.searchsorted(cum_sizes, budgets, side='right')
+        dense_deltas = np.where(
+            num_dense > 0, cum_gains[np.maximum(num_dense - 1, 0)], 0) - losses
+        # best single video
+        by_size = candidates[np.argsort(sizes[candidates], kind='stable')]
+        max_gains = np.maximum.accumulate(gains[by_size])
+        argmax_gains = np.maximum.accumulate(np.where(
+            gains[by_size] == max_gains, np.arange(len(by_size)), 0))
+        num_single = np.searchsorted(sizes[by_size], budgets, side='right')
+        single_deltas = np.where(
+            num_single > 0, max_gains[np.maximum(num_single - 1, 0)], 0) - \
+            losses
+        for i in np.flatnonzero((dense_deltas > 0) | (single_deltas > 0)):
+            if dense_deltas[i] >= single_deltas[i]:
+                move = (dense_deltas[i], [held_videos[i]],
+                        list(candidates[:num_dense[i]]))
+            else:
+                move = (single_deltas[i], [held_videos[i]],
+                        [by_size[argmax_gains[num_single[i] - 1]]])
+            moves.append(move)
+            if strategy == 'first':
+                return move
+    if moves:
+        return max(moves, key=operator.itemgetter(0))
+    else:
+        return None
+
+
+# ======================================================================
+class CachingLocalSearch(Caching):
+    def __init__(self, *args, **kwargs):
+        Caching.__init__(self, *args, **kwargs)
+
+    # ----------------------------------------------------------
+    def fill(
+            self,
+            network,
+            filepath=None,
+            strategy='first',
+            max_time=None,
+            max_sweeps=None,
+            stop_at_gap=None):
+        """
+        Improve the caches by hill climbing.
+
+        The moves on each cache are:
+         - add: add a video that fits;
+         - drop: remove the videos that do not save anything;
+         - swap: replace a video with the best single video that fits, or
+           with the videos with the largest saving per unit size that fit.
+        All moves of a cache are evaluated at once from the savings of its
+        videos given the other caches (see `Evaluator.cache_gains()`).
+        Each cache is improved until no move improves the score, and the
+        caches are swept until a full sweep does not improve.
+
+        Args:
+            network (Network): The network.
+            filepath (str|None): The output file.
+                If it exists, it is used as the starting point.
+                Otherwise, the current caches are used (if all empty, these
+                are first filled at random).
+                After each improving sweep, the result is saved to it.
+            strategy (str): The move selection strategy.
+                Accepted values are:
+                 - 'first': apply the first improving move;
+                 - 'best': apply the most improving move.
+            max_time (float|None): The time budget in seconds.
+                If None, iterate until convergence.
+            max_sweeps (int|None): The maximum number of sweeps.
+                If None, iterate until convergence.
+            stop_at_gap (float|None): The gap at which to stop.
+                The run stops when the gap of the best score from the upper
+                bound is not larger than this (see `Network.gap()`).
+                If None, the gap is only reported.
+
+        Returns:
+            None.
+        """
+        if strategy not in ('first', 'best'):
+            raise ValueError('Unknown strategy `{}`!'.format(strategy))
+        filename = os.path.basename(filepath) if filepath else ''
+        if filepath and os.path.isfile(filepath):
+            self.caches = Caching.load(filepath).caches
+        elif not any(self.caches):
+            Caching.fill(self, network)
+        evaluator = Evaluator(network, self)
+        sizes = evaluator.sizes
+        stop_time = time.time() + max_time if max_time is not None else None
+        stop_score = _stop_score(network, stop_at_gap)
+        begin_time = datetime.datetime.now()
+        sweep = 0
+        improved = evaluator.score < stop_score
+        while improved and (max_sweeps is None or sweep < max_sweeps):
+            improved = False
+            for cache in range(network.num_caches):
+                move = True
+                while move and (stop_time is None or time.time() < stop_time):
+                    gains = evaluator.cache_gains(cache)
+                    held = evaluator.placement[cache]
+                    # drop
+                    for video in np.flatnonzero(held & (gains <= 0)):
+                        evaluator.apply(cache, video, False)
+                    move = _local_move(
+                        gains, evaluator.placement[cache], sizes,
+                        evaluator.free[cache], strategy)
+                    if move:
+                        delta, removed, added = move
+                        for video in removed:
+                            evaluator.apply(cache, video, False)
+                        for video in added:
+                            evaluator.apply(cache, video, True)
+                        improved = True
+            end_time = datetime.datetime.now()
+            print('local search - {:20s} SCORE: {:7d}, gap={:.3%}, sweep={}, '
+                  't={}'.format(
+                    filename, evaluator.score, network.gap(evaluator.score),
+                    sweep, end_time - begin_time), flush=True)
+            begin_time = end_time
+            if improved and filepath:
+                self.save(filepath)
+            if stop_time is not None and time.time() >= stop_time or \
+                    evaluator.score >= stop_score:
+                break
+            sweep += 1
+
+
+# ======================================================================
+def _temperature(cooling, temperature, cooling_rate, step):
+    if callable(cooling):
+        return cooling(temperature, step)
+    elif cooling == 'geometric':
+        return temperature * cooling_rate ** step
+    elif cooling == 'linear':
+        return temperature * max(1 - cooling_rate * step, 0)
+    elif cooling == 'logarithmic':
+        return temperature / (1 + cooling_rate * math.log(1 + step))
+    else:
+        raise ValueError('Unknown cooling schedule `{}`!'.format(cooling))
+
+
+# ======================================================================
+def _random_move(evaluator, cache):
+    num_videos = evaluator.placement.shape[1]
+    held = np.flatnonzero(evaluator.placement[cache])
+    kind = random.randrange(3) if len(held) else 0
+    if kind == 0:
+        # add
+        video = random.randrange(num_videos)
+        if evaluator.placement[cache, video] or \
+                not evaluator.fits(cache, video):
+            return None
+        return evaluator.delta_add(cache, video), [], [video]
+    elif kind == 1:
+        # drop
+        video = held[random.randrange(len(held))]
+        return evaluator.delta_remove(cache, video), [video], []
+    else:
+        # swap
+        old_video = held[random.randrange(len(held))]
+        video = random.randrange(num_videos)
+        if evaluator.placement[cache, video] or \
+                evaluator.sizes[video] > \
+                evaluator.free[cache] + evaluator.sizes[old_video]:
+            return None
+        return (
+            evaluator.delta_remove(cache, old_video) +
+            evaluator.delta_add(cache, video), [old_video], [video])
+
+
+# ======================================================================
+class CachingAnnealing(Caching):
+    def __init__(self, *args, **kwargs):
+        Caching.__init__(self, *args, **kwargs)
+
+    # ----------------------------------------------------------
+    def fill(
+            self,
+            network,
+            filepath=None,
+            max_time=None,
+            max_iter=int(1e10),
+            temperature=None,
+            cooling='geometric',
+            cooling_rate=0.99995,
+            reheat_after=int(1e5),
+            reheat=0.5,
+            checkpoint_interval=10.0,
+            stop_at_gap=None):
+        """
+        Improve the caches by simulated annealing.
+
+        The moves are the add, drop and swap of single videos in a random
+        cache (see `CachingLocalSearch`), and are evaluated incrementally.
+        A move changing the total saving by `delta` is accepted with
+        probability `min(1, exp(delta / temperature))`.
+
+        Args:
+            network (Network): The network.
+            filepath (str|None): The output file.
+                If it exists, it is used as the starting point.
+                Otherwise, the current caches are used (if all empty, these
+                are first filled at random).
+                The best caching is saved to it when improved (at most every
+                `checkpoint_interval` seconds) and at the end.
+            max_time (float|None): The time budget in seconds.
+                If None, only `max_iter` is used.
+            max_iter (int): The maximum number of iterations.
+            temperature (float|None): The initial temperature.
+                This is in units of total latency saving.
+                If None, it is estimated so that about half of the worsening
+                moves are initially accepted.
+            cooling (str|callable): The cooling schedule.
+                Accepted values are:
+                 - 'geometric': `temperature * cooling_rate ** step`;
+                 - 'linear': `temperature * max(1 - cooling_rate * step, 0)`;
+                 - 'logarithmic':
+                   `temperature / (1 + cooling_rate * log(1 + step))`;
+                 - callable: `cooling(temperature, step)`.
+            cooling_rate (float): The parameter of the cooling schedule.
+            reheat_after (int|None): The iterations before reheating.
+                If the best score does not improve for this number of
+                iterations, the schedule restarts from `reheat` times its
+                previous starting temperature.
+                If None, no reheating is performed.
+            reheat (float): The reheating temperature factor.
+            checkpoint_interval (float): The minimum time between saves in s.
+            stop_at_gap (float|None): The gap at which to stop.
+                The run stops when the gap of the best score from the upper
+                bound is not larger than this (see `Network.gap()`).
+                If None, the gap is only reported.
+
+        Returns:
+            None.
+        """
+        filename = os.path.basename(filepath) if filepath else ''
+        if filepath and os.path.isfile(filepath):
+            self.caches = Caching.load(filepath).caches
+        elif not any(self.caches):
+            Caching.fill(self, network)
+        evaluator = Evaluator(network, self)
+        if temperature is None:
+            deltas = [
+                _random_move(evaluator, random.randrange(network.num_caches))
+                for _ in range(1000)]
+            deltas = [move[0] for move in deltas if move and move[0] < 0]
+            temperature = -np.mean(deltas) / math.log(2) if deltas else 1.0
+        stop_time = time.time() + max_time if max_time is not None else None
+        stop_score = _stop_score(network, stop_at_gap)
+        best_saving = evaluator.saving
+        best_score = evaluator.score
+        best_placement = evaluator.placement.copy()
+        last_saving = best_saving
+        last_time = time.time()
+        begin_time = datetime.datetime.now()
+        curr_temperature = temperature
+        step = last_improvement = 0
+        j = 0
+        while j < max_iter and best_score < stop_score and (
+                stop_time is None or time.time() < stop_time):
+            cache = random.randrange(network.num_caches)
+            move = _random_move(evaluator, cache)
+            if move is not None:
+                delta, removed, added = move
+                if delta >= 0 or (
+                        curr_temperature > 0 and
+                        random.random() < math.exp(delta / curr_temperature)):
+                    for video in removed:
+                        evaluator.apply(cache, video, False)
+                    for video in added:
+                        evaluator.apply(cache, video, True)
+                    if evaluator.saving > best_saving:
+                        best_saving = evaluator.saving
+                        best_score = evaluator.score
+                        best_placement[...] = evaluator.placement
+                        last_improvement = j
+            # reheating
+            if reheat_after is not None and j - last_improvement > reheat_after:
+                temperature *= reheat
+                step = 0
+                last_improvement = j
+            else:
+                step += 1
+            curr_temperature = _temperature(
+                cooling, temperature, cooling_rate, step)
+            # checkpoint
+            if best_saving > last_saving and \
+                    time.time() - last_time >= checkpoint_interval:
+                self._checkpoint(
+                    best_placement, evaluator, filepath, filename,
+                    curr_temperature, j, begin_time)
+                last_saving = best_saving
+                last_time = time.time()
+                begin_time = datetime.datetime.now()
+            j += 1
+        self._checkpoint(
+            best_placement, evaluator, filepath, filename, curr_temperature, j,
+            begin_time)
+        self.caches = CachingMatrix(best_placement).to_caching().caches
+
+    # ----------------------------------------------------------
+    def _checkpoint(
+            self, placement, evaluator, filepath, filename, temperature, j,
+            begin_time):
+        score = evaluator.network.score_placement(placement)
+        end_time = datetime.datetime.now()
+        print('annealing - {:20s} SCORE: {:7d}  ({})  gap={:.3%}, T={:.4g}, '
+              'j={}, t={}'.format(
+                filename, score, evaluator.score,
+                evaluator.network.gap(score), temperature, j,
+                end_time - begin_time), flush=True)
+        if filepath:
+            CachingMatrix(placement).to_caching().save(filepath)
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+quarkball2017: synthetic instance generator
+
+Write random networks in the `.in` format (and in the binary format of
+`Network.save_bin()`), streaming the output in chunks, so that instances
+much larger than the provided datasets can be generated.
+"""
+
+# ======================================================================
+# :: Imports
+from __future__ import (
+    division, absolute_import, print_function, unicode_literals)
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+
+import numpy as np
+
+from quarkball.utils import (
+    BIN_VERSION, _cache_dirpath, _compact, _replace_dir)
+
+DEGREES = ('constant', 'uniform', 'zipf')
+
+
+# ======================================================================
+def _power_law(rng, num, low, high, exponent):
+    # integers in [low, high] with probability ~ value ** -exponent
+    # (inverse transform of the continuous law on [low, high + 1))
+    uniform = rng.random(num)
+    low, high = float(low), float(high) + 1
+    if exponent == 0:
+        values = low + uniform * (high - low)
+    elif exponent == 1:
+        values = low * (high / low) ** uniform
+    else:
+        power = 1 - exponent
+        values = (low ** power + uniform * (
+            high ** power - low ** power)) ** (1 / power)
+    return np.minimum(np.floor(values), high - 1).astype(np.int64)
+
+
+# ======================================================================
+class _Writer(object):
+    # text output hashed on the fly (see `utils._content_key()`)
+    def __init__(self, filepath):
+        self.file = open(filepath, 'wb')
+        self.hasher = hashlib.sha1()
+        self.size = 0
+
+    def write(self, text):
+        data = text.encode('ascii')
+        self.file.write(data)
+        self.hasher.update(data)
+        self.size += len(data)
+
+    def close(self):
+        self.file.close()
+        return '{}:{}'.format(self.size, self.hasher.hexdigest())
+
+
+# ======================================================================
+def _open_array(dirpath, name, shape, dtype):
+    if dirpath is None:
+        return None
+    filepath = os.path.join(dirpath, name + '.npy')
+    if not shape:
+        # empty files cannot be memory-mapped
+        array = np.zeros(shape, dtype=dtype)
+        np.save(filepath, array)
+        return array
+    return np.lib.format.open_memmap(
+        filepath, mode='w+', dtype=dtype, shape=(shape,))
+
+
+# ======================================================================
+def _compact_array(dirpath, name, max_value, chunk_size):
+    # match the dtype chosen by `utils._compact()` for the actual values
+    filepath = os.path.join(dirpath, name + '.npy')
+    array = np.load(filepath, mmap_mode='r')
+    dtype = _compact(np.array([max_value])).dtype
+    if not len(array):
+        np.save(filepath, array.astype(dtype))
+    elif array.dtype != dtype:
+        tmp_filepath = filepath + '.tmp'
+        compacted = np.lib.format.open_memmap(
+            tmp_filepath, mode='w+', dtype=dtype, shape=array.shape)
+        for i in range(0, len(array), chunk_size):
+            compacted[i:i + chunk_size] = array[i:i + chunk_size]
+        compacted.flush()
+        del compacted, array
+        os.replace(tmp_filepath, filepath)
+
+
+# ======================================================================
+def generate(
+        filepath,
+        num_videos=10000,
+        num_endpoints=1000,
+        num_caches=100,
+        num_requests=1000000,
+        cache_size=None,
+        min_video_size=1,
+        max_video_size=1000,
+        size_exponent=1.0,
+        popularity_exponent=1.0,
+        degree='uniform',
+        max_degree=None,
+        degree_exponent=1.0,
+        max_count=1000,
+        count_exponent=1.5,
+        max_latency=4000,
+        max_cache_latency=500,
+        binary=True,
+        seed=None,
+        chunk_size=2 ** 20):
+    """
+    Generate a random network.
+
+    The video sizes and the numbers of requests follow truncated power
+    laws, and the videos are requested with Zipf-like popularity (the
+    popularity ranks are randomly assigned to the videos).
+    The requesting endpoints are uniformly distributed.
+    The endpoint latencies are uniform in [2, `max_latency`] and the
+    latency of each connection is uniform in [1, `max_cache_latency`],
+    but lower than the latency of its endpoint.
+    The same (video, endpoint) pair may be requested more than once
+    (see `Network.merge_requests()`).
+
+    The output is streamed: only the videos, the endpoints and a chunk of
+    connections or requests are kept in memory.
+    Each quantity is drawn from its own random stream, so that the result
+    does not depend on `chunk_size`.
+
+    Args:
+        filepath (str): The output `.in` file.
+        num_videos (int): The number of videos.
+        num_endpoints (int): The number of endpoints.
+        num_caches (int): The number of caches.
+        num_requests (int): The number of requests.
+        cache_size (int|None): The capacity of each cache.
+            If None, a cache holds about 100 videos of average size.
+        min_video_size (int): The minimum video size.
+        max_video_size (int): The maximum video size.
+        size_exponent (float): The exponent of the video sizes law.
+            If 0, the sizes are uniform.
+        popularity_exponent (float): The exponent of the Zipf popularity.
+            The video of rank `r` has probability ~ `r ** -exponent`.
+            If 0, the videos are equally popular.
+        degree (str): The distribution of the connections per endpoint.
+            Accepted values are:
+             - 'constant': `max_degree` caches for each endpoint;
+             - 'uniform': uniform in [0, `max_degree`];
+             - 'zipf': `d` caches with probability ~
+               `(d + 1) ** -degree_exponent`, for `d` in [0, `max_degree`].
+        max_degree (int|None): The maximum number of connections.
+            If None, `num_caches` is used.
+        degree_exponent (float): The exponent of the 'zipf' degrees.
+        max_count (int): The maximum number of requests of a request.
+        count_exponent (float): The exponent of the request counts law.
+        max_latency (int): The maximum endpoint latency.
+        max_cache_latency (int): The maximum connection latency.
+        binary (bool): Also write the binary sidecar of the `.in` file.
+            This is the directory used by `Network.load()` (see
+            `Network.save_bin()`), so that the network can be memory-mapped
+            without parsing the text.
+        seed (int|None): The seed for the random generators.
+        chunk_size (int): The number of values generated at once.
+
+    Returns:
+        None.
+    """
+    if degree not in DEGREES:
+        raise ValueError('Unknown degree distribution `{}`!'.format(degree))
+    if max_degree is None:
+        max_degree = num_caches
+    max_degree = min(max_degree, num_caches)
+    streams = [
+        np.random.default_rng(child)
+        for child in np.random.SeedSequence(seed).spawn(9)]
+    (size_rng, rank_rng, latency_rng, degree_rng, cache_rng,
+     link_latency_rng, video_rng, endpoint_rng, count_rng) = streams
+
+    videos = _power_law(
+        size_rng, num_videos, min_video_size, max_video_size, size_exponent)
+    if cache_size is None:
+        cache_size = int(100 * np.mean(videos))
+    popularity = np.cumsum(
+        np.arange(1, num_videos + 1, dtype=np.float64) **
+        -popularity_exponent)
+    ranks = rank_rng.permutation(num_videos)
+    endpoint_latencies = latency_rng.integers(
+        2, max_latency + 1, num_endpoints)
+    if degree == 'constant':
+        degrees = np.full(num_endpoints, max_degree, dtype=np.int64)
+    elif degree == 'uniform':
+        degrees = degree_rng.integers(0, max_degree + 1, num_endpoints)
+    else:
+        degrees = _power_law(
+            degree_rng, num_endpoints, 1, max_degree + 1, degree_exponent) - 1
+    link_offsets = np.zeros(num_endpoints + 1, dtype=np.int64)
+    np.cumsum(degrees, out=link_offsets[1:])
+    num_links = int(link_offsets[-1])
+
+    tmp_filepath = '{}.{}.tmp'.format(filepath, os.getpid())
+    bin_dirpath = _cache_dirpath(filepath) if binary else None
+    tmp_dirpath = '{}.{}.tmp'.format(bin_dirpath, os.getpid()) \
+        if binary else None
+    if binary:
+        if os.path.isdir(tmp_dirpath):
+            shutil.rmtree(tmp_dirpath)
+        os.makedirs(tmp_dirpath)
+        for name, array in (
+                ('videos', videos),
+                ('endpoint_latencies',
+                 endpoint_latencies.astype(np.float64)),
+                ('link_offsets', link_offsets)):
+            np.save(os.path.join(tmp_dirpath, name + '.npy'), array)
+    link_caches = _open_array(tmp_dirpath, 'link_caches', num_links, np.int32)
+    link_latencies = _open_array(
+        tmp_dirpath, 'link_latencies', num_links, np.int64)
+    req_arrays = [
+        _open_array(tmp_dirpath, name, num_requests, _compact(
+            np.array([max_value])).dtype)
+        for name, max_value in (
+            ('req_video', num_videos - 1),
+            ('req_endpoint', num_endpoints - 1),
+            ('req_count', max_count))]
+
+    writer = _Writer(tmp_filepath)
+    writer.write('{} {} {} {} {}\n'.format(
+        num_videos, num_endpoints, num_requests, num_caches, cache_size))
+    for i in range(0, num_videos, chunk_size):
+        writer.write(' '.join(map(str, videos[i:i + chunk_size].tolist())))
+        writer.write(' ' if i + chunk_size < num_videos else '\n')
+
+    # connections: chunks of endpoints, each with distinct random caches,
+    # sorted by latency (as stored by `Network`)
+    step = max(1, chunk_size // max(1, num_caches))
+    for first in range(0, num_endpoints, step):
+        last = min(first + step, num_endpoints)
+        chunk_degrees = degrees[first:last]
+        caches = np.argsort(
+            cache_rng.random((last - first, num_caches)), axis=1)
+        caches = caches[np.arange(num_caches) < chunk_degrees[:, None]]
+        rows = np.repeat(np.arange(last - first), chunk_degrees)
+        latencies = link_latency_rng.integers(
+            1, np.minimum(
+                max_cache_latency, endpoint_latencies[first:last] - 1)[rows]
+            + 1)
+        order = np.lexsort((latencies, rows))
+        caches, latencies = caches[order], latencies[order]
+        begin, end = link_offsets[first], link_offsets[last]
+        if binary:
+            link_caches[begin:end] = caches
+            link_latencies[begin:end] = latencies
+        # the endpoint lines interleaved with their connection lines
+        lines = np.zeros((last - first + end - begin, 2), dtype=np.int64)
+        headers = link_offsets[first:last] - begin + np.arange(last - first)
+        lines[headers, 0] = endpoint_latencies[first:last]
+        lines[headers, 1] = chunk_degrees
+        is_link = np.ones(len(lines), dtype=bool)
+        is_link[headers] = False
+        lines[is_link, 0] = caches
+        lines[is_link, 1] = latencies
+        writer.write('%d %d\n' * len(lines) % tuple(lines.ravel().tolist()))
+
+    max_values = [0, 0, 0]
+    step = max(1, chunk_size // 3)
+    for first in range(0, num_requests, step):
+        num = min(step, num_requests - first)
+        requests = np.stack([
+            ranks[np.minimum(np.searchsorted(
+                popularity, video_rng.random(num) * popularity[-1]),
+                num_videos - 1)],
+            endpoint_rng.integers(0, num_endpoints, num),
+            _power_law(count_rng, num, 1, max_count, count_exponent)],
+            axis=1)
+        for j, req_array in enumerate(req_arrays):
+            max_values[j] = max(max_values[j], int(np.max(requests[:, j])))
+            if binary:
+                req_array[first:first + num] = requests[:, j]
+        writer.write(
+            '%d %d %d\n' * num % tuple(requests.ravel().tolist()))
+    key = writer.close()
+
+    if binary:
+        for array in [link_caches, link_latencies] + req_arrays:
+            if isinstance(array, np.memmap):
+                array.flush()
+        del link_caches, link_latencies, req_arrays
+        for name, max_value in zip(
+                ('req_video', 'req_endpoint', 'req_count'), max_values):
+            _compact_array(tmp_dirpath, name, max_value, chunk_size)
+        with open(os.path.join(tmp_dirpath, 'meta.json'), 'w') as file:
+            json.dump(dict(
+                version=BIN_VERSION, cache_size=int(cache_size),
+                num_caches=int(num_caches), key=key), file)
+    os.replace(tmp_filepath, filepath)
+    if binary:
+        _replace_dir(tmp_dirpath, bin_dirpath)
+
+
+# ======================================================================
+def handle_arg():
+    """
+    Handle command-line application arguments.
+    """
+    arg_parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument(
+        'filepath',
+        help='the output `.in` file')
+    arg_parser.add_argument(
+        '-V', '--num_videos', type=int, default=10000,
+        help='the number of videos [%(default)s]')
+    arg_parser.add_argument(
+        '-E', '--num_endpoints', type=int, default=1000,
+        help='the number of endpoints [%(default)s]')
+    arg_parser.add_argument(
+        '-C', '--num_caches', type=int, default=100,
+        help='the number of caches [%(default)s]')
+    arg_parser.add_argument(
+        '-R', '--num_requests', type=int, default=1000000,
+        help='the number of requests [%(default)s]')
+    arg_parser.add_argument(
+        '-X', '--cache_size', type=int,
+        help='the capacity of each cache [about 100 videos]')
+    arg_parser.add_argument(
+        '--min_video_size', type=int, default=1,
+        help='the minimum video size [%(default)s]')
+    arg_parser.add_argument(
+        '--max_video_size', type=int, default=1000,
+        help='the maximum video size [%(default)s]')
+    arg_parser.add_argument(
+        '--size_exponent', type=float, default=1.0,
+        help='the exponent of the video sizes law [%(default)s]')
+    arg_parser.add_argument(
+        '--popularity_exponent', type=float, default=1.0,
+        help='the exponent of the Zipf popularity [%(default)s]')
+    arg_parser.add_argument(
+        '--degree', choices=DEGREES, default='uniform',
+        help='the distribution of the connections [%(default)s]')
+    arg_parser.add_argument(
+        '--max_degree', type=int,
+        help='the maximum number of connections [num_caches]')
+    arg_parser.add_argument(
+        '--degree_exponent', type=float, default=1.0,
+        help='the exponent of the zipf degrees [%(default)s]')
+    arg_parser.add_argument(
+        '--max_count', type=int, default=1000,
+        help='the maximum number of requests of a request [%(default)s]')
+    arg_parser.add_argument(
+        '--count_exponent', type=float, default=1.5,
+        help='the exponent of the request counts law [%(default)s]')
+    arg_parser.add_argument(
+        '--max_latency', type=int, default=4000,
+        help='the maximum endpoint latency [%(default)s]')
+    arg_parser.add_argument(
+        '--max_cache_latency', type=int, default=500,
+        help='the maximum connection latency [%(default)s]')
+    arg_parser.add_argument(
+        '--no_binary', dest='binary', action='store_false',
+        help='do not write the binary sidecar')
+    arg_parser.add_argument(
+        '--seed', type=int,
+        help='the seed for the random generators [%(default)s]')
+    return arg_parser
+
+
+# ======================================================================
+def main():
+    arg_parser = handle_arg()
+    kws = vars(arg_parser.parse_args())
+    generate(kws.pop('filepath'), **kws)
+    return 0
+
+
+# ======================================================================
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,459 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+quarkball2017: shared-memory parallel execution
+"""
+
+# ======================================================================
+# :: Imports
+from __future__ import (
+    division, absolute_import, print_function, unicode_literals)
+
+import atexit
+import random
+import weakref
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from quarkball.utils import Network
+
+# arrays of the network published to the workers
+NETWORK_ARRAYS = (
+    'videos', 'endpoint_latencies', 'link_offsets', 'link_caches',
+    'link_latencies', 'req_video', 'req_endpoint', 'req_count')
+
+# segments attached by this process (kept alive while in use)
+_ATTACHED = {}
+# state of the worker processes
+_WORKER = {}
+
+
+# ======================================================================
+def share_arrays(arrays):
+    """
+    Copy arrays to shared memory.
+
+    Args:
+        arrays (dict[str:np.ndarray]): The arrays to share.
+
+    Returns:
+        result (tuple): The tuple contains:
+            - handle (dict[str:tuple]): The picklable description of the
+              shared arrays (to be used with `attach_arrays()`).
+            - segments (list[SharedMemory]): The shared memory segments.
+              These must be closed and unlinked by the owner.
+            - shared (dict[str:np.ndarray]): The arrays in shared memory.
+    """
+    handle, segments, shared = {}, [], {}
+    for name, array in arrays.items():
+        array = np.asarray(array)
+        segment = shared_memory.SharedMemory(
+            create=True, size=max(1, array.nbytes))
+        shared[name] = np.ndarray(
+            array.shape, dtype=array.dtype, buffer=segment.buf)
+        shared[name][...] = array
+        handle[name] = (segment.name, array.shape, array.dtype.str)
+        segments.append(segment)
+    return handle, segments, shared
+
+
+# ======================================================================
+def attach_arrays(handle):
+    """
+    Access arrays in shared memory.
+
+    Args:
+        handle (dict[str:tuple]): The description of the shared arrays.
+            See `share_arrays()` for more info.
+
+    Returns:
+        arrays (dict[str:np.ndarray]): The arrays in shared memory.
+    """
+    arrays = {}
+    for name, (segment_name, shape, dtype) in handle.items():
+        if segment_name not in _ATTACHED:
+            _ATTACHED[segment_name] = _attach(segment_name)
+        arrays[name] = np.ndarray(
+            shape, dtype=dtype, buffer=_ATTACHED[segment_name].buf)
+    return arrays
+
+
+# ======================================================================
+def _attach(segment_name):
+    try:
+        return shared_memory.SharedMemory(name=segment_name, track=False)
+    except TypeError:
+        # Python < 3.13: workers share the resource tracker of the creator,
+        # so tracking the segment again is harmless
+        return shared_memory.SharedMemory(name=segment_name)
+
+
+# ======================================================================
+def _release(segments):
+    for segment in segments:
+        segment.close()
+        try:
+            segment.unlink()
+        except FileNotFoundError:
+            pass
+
+
+# ======================================================================
+def network_arrays(network):
+    """
+    Collect the arrays of a network (see `NETWORK_ARRAYS`).
+
+    Args:
+        network (Network): The network.
+
+    Returns:
+        arrays (dict[str:np.ndarray]): The arrays of the network.
+            The scalar parameters are stored as 0-dim arrays.
+    """
+    arrays = {name: getattr(network, name) for name in NETWORK_ARRAYS}
+    arrays['cache_size'] = np.array(network.cache_size)
+    arrays['num_caches'] = np.array(network.num_caches)
+    return arrays
+
+
+# ======================================================================
+def network_from_arrays(arrays, first=0, last=None):
+    """
+    Build a network from its arrays, without copying them.
+
+    Args:
+        arrays (dict[str:np.ndarray]): The arrays of the network.
+            See `network_arrays()` for more info.
+        first (int): The first request to include.
+        last (int|None): The last request to include (excluded).
+            If None, all requests after `first` are included.
+
+    Returns:
+        network (Network): The network.
+    """
+    network = Network(
+        arrays['videos'], arrays['endpoint_latencies'],
+        int(arrays['cache_size']), None, None,
+        (arrays['link_offsets'], arrays['link_caches'],
+         arrays['link_latencies']),
+        int(arrays['num_caches']))
+    network.set_requests(
+        arrays['req_video'][first:last], arrays['req_endpoint'][first:last],
+        arrays['req_count'][first:last])
+    return network
+
+
+# ======================================================================
+class WorkerPool(object):
+    def __init__(
+            self,
+            network=None,
+            processes=None,
+            seed=None):
+        """
+        Persistent pool of worker processes sharing a network.
+
+        The network arrays are copied to shared memory once, and each
+        worker builds a zero-copy `Network` on them at startup, which is
+        available to the tasks through `worker_network()`.
+        Additional arrays (e.g. a population) can be shared with `share()`,
+        so that the tasks only receive their small handle.
+        A lock shared by all workers is available through `worker_lock()`.
+        The workers and the shared memory are released by `close()` (also
+        when leaving the `with` block), or on exit.
+        If the `with` block is left by an exception (e.g. an interrupt),
+        the pending tasks are dropped and the workers are terminated.
+
+        Args:
+            network (Network|None): The network to share with the workers.
+            processes (int|None): The number of worker processes.
+                If None, `multiprocessing.cpu_count()` is used.
+            seed (int|None): The seed for the random generators.
+                Each worker seeds `random` and `np.random` from `seed` and its
+                own index (from 0 to `processes - 1`, in order of startup),
+                so that workers do not draw the same numbers, and the same
+                streams are used regardless of the pools created before.
+                If None, the generators are seeded from the OS entropy.
+        """
+        self.processes = processes or multiprocessing.cpu_count()
+        self._segments = []
+        self.network_handle = None
+        if network is not None:
+            self.network_handle, segments, _ = share_arrays(
+                network_arrays(network))
+            self._segments.extend(segments)
+        self.lock = multiprocessing.Lock()
+        self._counter = multiprocessing.Value('i', 0)
+        self.pool = multiprocessing.Pool(
+            self.processes, initializer=_init_worker,
+            initargs=(self.network_handle, seed, self.lock, self._counter))
+        self._finalizer = weakref.finalize(
+            self, _shutdown, self.pool, self._segments)
+
+    # ----------------------------------------------------------
+    def __enter__(self):
+        return self
+
+    # ----------------------------------------------------------
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    # ----------------------------------------------------------
+    def close(self):
+        """
+        Wait for the pending tasks, then stop the workers.
+
+        Returns:
+            None.
+        """
+        if self._finalizer.alive:
+            self.pool.close()
+            self.pool.join()
+        self._finalizer()
+
+    # ----------------------------------------------------------
+    def terminate(self):
+        """
+        Stop the workers immediately, dropping the pending tasks.
+
+        Returns:
+            None.
+        """
+        self._finalizer()
+
+    # ----------------------------------------------------------
+    def share(self, arrays):
+        """
+        Copy arrays to shared memory owned by the pool.
+
+        Args:
+            arrays (dict[str:np.ndarray]): The arrays to share.
+
+        Returns:
+            result (tuple): The tuple contains:
+                - handle (dict[str:tuple]): The handle for the workers.
+                  See `attach_arrays()` for more info.
+                - shared (dict[str:np.ndarray]): The arrays in shared memory.
+                  These can be modified in place between task submissions.
+        """
+        handle, segments, shared = share_arrays(arrays)
+        self._segments.extend(segments)
+        return handle, shared
+
+    # ----------------------------------------------------------
+    def apply_async(self, func, args=(), kwds=None):
+        return self.pool.apply_async(func, args, kwds or {})
+
+    # ----------------------------------------------------------
+    def starmap(self, func, iterable):
+        return self.pool.starmap(func, iterable)
+
+
+# ======================================================================
+def _shutdown(pool, segments):
+    pool.terminate()
+    pool.join()
+    _release(segments)
+
+
+# ======================================================================
+def _init_worker(network_handle, seed, lock=None, counter=None):
+    _WORKER.clear()
+    _WORKER['network_handle'] = network_handle
+    _WORKER['lock'] = lock
+    _WORKER['chunks'] = {}
+    # the index of the worker in its pool (not the process identity, which
+    # depends on the pools created before)
+    index = 0
+    if counter is not None:
+        with counter.get_lock():
+            index = counter.value
+            counter.value += 1
+    _WORKER['index'] = index
+    if seed is None:
+        random.seed()
+        np.random.seed()
+    else:
+        random.seed('{}:{}'.format(seed, index))
+        np.random.seed(
+            np.random.SeedSequence([seed, index]).generate_state(1))
+
+
+# ======================================================================
+def worker_arrays():
+    """
+    Get the arrays of the network shared with the current worker.
+
+    Returns:
+        arrays (dict[str:np.ndarray]): The arrays of the network.
+            See `network_arrays()` for more info.
+    """
+    if 'network_arrays' not in _WORKER:
+        if not _WORKER.get('network_handle'):
+            raise RuntimeError('No network shared with this process!')
+        _WORKER['network_arrays'] = attach_arrays(_WORKER['network_handle'])
+    return _WORKER['network_arrays']
+
+
+# ======================================================================
+def worker_network():
+    """
+    Get the network shared with the current worker.
+
+    Returns:
+        network (Network): The network (built on first use).
+    """
+    if 'network' not in _WORKER:
+        _WORKER['network'] = network_from_arrays(worker_arrays())
+    return _WORKER['network']
+
+
+# ======================================================================
+def worker_lock():
+    """
+    Get the lock shared by the workers of the current pool.
+
+    Returns:
+        lock (multiprocessing.Lock): The lock.
+    """
+    return _WORKER['lock']
+
+
+# ======================================================================
+class ParallelScorer(object):
+    def __init__(
+            self,
+            network,
+            processes=None,
+            chunks_per_process=2):
+        """
+        Score placements in parallel over chunks of requests.
+
+        The network arrays and a placement buffer are copied to shared
+        memory once, and the worker processes are started once.
+        Each call only copies the placement to the shared buffer, and each
+        worker receives the bounds of a large contiguous chunk of requests.
+        No reference to the network is kept, so that the persistent scorer
+        can be closed when the network is garbage-collected (see
+        `get_scorer()`).
+
+        Args:
+            network (Network): The network.
+            processes (int|None): The number of worker processes.
+                If None, `multiprocessing.cpu_count()` is used.
+            chunks_per_process (int): The number of chunks per process.
+        """
+        self.workers = WorkerPool(network, processes)
+        self.handle, shared = self.workers.share({
+            'placement': np.zeros(
+                (network.num_caches, network.num_videos), dtype=bool)})
+        self.placement = shared['placement']
+        bounds = np.linspace(
+            0, network.num_requests,
+            self.workers.processes * chunks_per_process + 1)
+        bounds = np.unique(bounds.astype(np.int64))
+        self.chunks = [
+            (self.handle, first, last)
+            for first, last in zip(bounds[:-1].tolist(), bounds[1:].tolist())]
+        self.num_tot = int(np.sum(network.req_count, dtype=np.int64))
+
+    # ----------------------------------------------------------
+    def __enter__(self):
+        return self
+
+    # ----------------------------------------------------------
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.workers.__exit__(exc_type, exc_value, traceback)
+
+    # ----------------------------------------------------------
+    def close(self):
+        self.workers.close()
+
+    # ----------------------------------------------------------
+    def savings(self, placement):
+        """
+        Compute the total latency saving of a placement.
+
+        Args:
+            placement (np.ndarray): The (num_caches, num_videos) placement.
+
+        Returns:
+            saving (int): The total latency saving.
+        """
+        self.placement[...] = placement
+        return sum(self.workers.starmap(_chunk_savings, self.chunks))
+
+    # ----------------------------------------------------------
+    def score(self, placement):
+        """
+        Compute the score of a placement.
+
+        Args:
+            placement (np.ndarray): The (num_caches, num_videos) placement.
+
+        Returns:
+            score (int): The same score as `Network.score_placement()`.
+        """
+        return int(self.savings(placement) / self.num_tot * 1000)
+
+
+# ======================================================================
+def _chunk_savings(handle, first, last):
+    if (first, last) not in _WORKER['chunks']:
+        _WORKER['chunks'][first, last] = network_from_arrays(
+            worker_arrays(), first, last)
+    network = _WORKER['chunks'][first, last]
+    return int(network.savings(attach_arrays(handle)['placement'])[0])
+
+
+# ======================================================================
+_SCORERS = {}
+
+
+# ======================================================================
+def get_scorer(network, processes=None):
+    """
+    Get the persistent parallel scorer of a network.
+
+    Args:
+        network (Network): The network.
+        processes (int|None): The number of worker processes.
+            If None, `multiprocessing.cpu_count()` is used.
+
+    Returns:
+        scorer (ParallelScorer): The scorer.
+            This is created on first use, and closed when the network is
+            garbage-collected or on exit.
+            If a different number of processes is requested, the scorer is
+            closed and created again.
+    """
+    key = id(network)
+    processes = processes or multiprocessing.cpu_count()
+    scorer = _SCORERS.get(key)
+    if scorer is not None and scorer.workers.processes != processes:
+        scorer.close()
+        scorer = None
+    if scorer is None:
+        if key not in _SCORERS:
+            weakref.finalize(network, _drop_scorer, key)
+        scorer = _SCORERS[key] = ParallelScorer(network, processes)
+    return scorer
+
+
+# ======================================================================
+def _drop_scorer(key):
+    scorer = _SCORERS.pop(key, None)
+    if scorer is not None:
+        scorer.close()
+
+
+# ======================================================================
+@atexit.register
+def _close_scorers():
+    for key in list(_SCORERS):
+        _drop_scorer(key)
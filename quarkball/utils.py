@@ -9,20 +9,51 @@ quarkball2017: base classes
 from __future__ import (
     division, absolute_import, print_function, unicode_literals)
 
+import os
+import time
+import json
+import shutil
+import hashlib
+import itertools
+import collections.abc
 import random
-import multiprocessing
 import numpy as np
 
 try:
-    from numba import jit
+    from numba import jit, njit, prange
 except ImportError:
     print('E: Numba not found!')
+    HAS_NUMBA = False
 
 
     def jit(_):
         return _
+
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        else:
+            return lambda func: func
+
+
+    prange = range
 else:
     print('I: Using Numba!')
+    HAS_NUMBA = True
+
+# available scoring engines (see `set_score_engine()`)
+SCORE_ENGINES = ('numpy', 'numba', 'numba_par')
+SCORE_ENGINE = os.environ.get(
+    'QUARKBALL_SCORE_ENGINE', 'numba' if HAS_NUMBA else 'numpy')
+# the process owning the Numba thread pool (not usable after a fork)
+_PARALLEL_PID = None
+
+
+BIN_VERSION = 3
+BIN_ARRAYS = (
+    'videos', 'endpoint_latencies', 'link_offsets', 'link_caches',
+    'link_latencies', 'req_video', 'req_endpoint', 'req_count')
 
 
 # ======================================================================
@@ -32,8 +63,10 @@ class Network(object):
             videos,
             endpoint_latencies,
             cache_size,
-            cache_latencies,
-            requests=None):
+            cache_latencies=None,
+            requests=None,
+            links=None,
+            num_caches=None):
         """
         Generate the network.
 
@@ -43,20 +76,52 @@ class Network(object):
                 The indexes correspond to the video ID.
             endpoint_latencies (np.ndarray): The latency of endpoints.
             cache_size (int): The capacity of each caching server in MB.
-            cache_latencies (np.ndarray): The cache latency of endpoints.
+            cache_latencies (np.ndarray|None): The cache latency of endpoints.
                 First dim goes through endpoints.
                 Second dim goes through caches.
-            requests (list[tuple]): The list of requests.
+                A value of 0 means that the cache is not connected.
+                If None, `links` and `num_caches` must be supplied.
+            requests (list[tuple]|np.ndarray): The list of requests.
                 Each tuple contains:
                 - the video ID;
                 - the requesting endpoint;
                 - the number of requests.
+                An array of shape (num_requests, 3) is also accepted.
+                Internally, requests are stored as the `req_video`,
+                `req_endpoint` and `req_count` arrays (with the smallest
+                integer type holding their values), and the list form is
+                only built when `requests` is accessed.
+            links (tuple[np.ndarray]|None): The endpoint-cache connections.
+                This is the CSR form of `cache_latencies`, i.e. the
+                `link_offsets`, `link_caches` and `link_latencies` arrays
+                (see below). Ignored if `cache_latencies` is supplied.
+            num_caches (int|None): The number of caching servers.
+                Only used if `cache_latencies` is not supplied.
+
+        The endpoint-cache connections are stored in CSR form:
+         - `link_offsets` (num_endpoints + 1): the connections of endpoint
+           `i` are in the `link_offsets[i]:link_offsets[i + 1]` range;
+         - `link_caches`: the connected cache for each connection;
+         - `link_latencies`: the latency for each connection.
+        The connections of each endpoint are sorted by ascending latency.
+        The dense `cache_latencies` matrix is only built when accessed.
         """
+        self._expanded = None
+        self._upper_bound = None
         self.videos = videos
         self.endpoint_latencies = endpoint_latencies
         self.cache_size = cache_size
-        self.cache_latencies = cache_latencies
-        self._requests = requests
+        self.requests = requests if requests is not None else []
+        if cache_latencies is not None:
+            self.cache_latencies = cache_latencies
+        elif links is not None and num_caches is not None:
+            self.link_offsets, self.link_caches, self.link_latencies = links
+            self._num_caches = num_caches
+            self._cache_latencies = None
+        else:
+            raise AttributeError(
+                'Either `cache_latencies` or `links` and `num_caches` '
+                'must be supplied!')
 
     # ----------------------------------------------------------
     @property
@@ -71,22 +136,117 @@ class Network(object):
     # ----------------------------------------------------------
     @property
     def num_caches(self):
-        return self.cache_latencies.shape[1]
+        return self._num_caches
+
+    # ----------------------------------------------------------
+    @property
+    def cache_latencies(self):
+        if self._cache_latencies is None:
+            self._cache_latencies = np.zeros(
+                (self.num_endpoints, self.num_caches))
+            self._cache_latencies[
+                self.link_endpoints, self.link_caches] = self.link_latencies
+        return self._cache_latencies
+
+    # ----------------------------------------------------------
+    @cache_latencies.setter
+    def cache_latencies(self, value):
+        endpoints, caches = np.nonzero(value)
+        self.link_offsets, self.link_caches, self.link_latencies = \
+            _links_from_pairs(
+                len(value), endpoints, caches, value[endpoints, caches])
+        self._num_caches = value.shape[1]
+        self._cache_latencies = value
+        self._expanded = None
+        self._upper_bound = None
+
+    # ----------------------------------------------------------
+    @property
+    def link_endpoints(self):
+        return np.repeat(
+            np.arange(self.num_endpoints), np.diff(self.link_offsets))
+
+    # ----------------------------------------------------------
+    def links(self, endpoint):
+        """
+        Get the connections of an endpoint.
+
+        Args:
+            endpoint (int): The endpoint ID.
+
+        Returns:
+            result (tuple[np.ndarray]): The tuple contains:
+                - caches (np.ndarray): The connected caches.
+                - latencies (np.ndarray): The corresponding latencies.
+                Connections are sorted by ascending latency.
+        """
+        i, j = self.link_offsets[endpoint], self.link_offsets[endpoint + 1]
+        return self.link_caches[i:j], self.link_latencies[i:j]
 
     # ----------------------------------------------------------
     @property
     def num_requests(self):
-        return len(self.requests)
+        return len(self.req_video)
 
     # ----------------------------------------------------------
     @property
     def requests(self):
+        if self._requests is None:
+            self._requests = list(zip(
+                self.req_video.tolist(), self.req_endpoint.tolist(),
+                self.req_count.tolist()))
         return self._requests
 
     # ----------------------------------------------------------
     @requests.setter
     def requests(self, value):
-        self._requests = value
+        value = np.asarray(value, dtype=np.int64).reshape(-1, 3)
+        self.set_requests(value[:, 0], value[:, 1], value[:, 2])
+
+    # ----------------------------------------------------------
+    def set_requests(self, req_video, req_endpoint, req_count):
+        """
+        Set the requests from their columns.
+
+        Args:
+            req_video (np.ndarray): The requested video IDs.
+            req_endpoint (np.ndarray): The requesting endpoints.
+            req_count (np.ndarray): The number of requests.
+
+        Returns:
+            None.
+        """
+        self.req_video = _compact(req_video)
+        self.req_endpoint = _compact(req_endpoint)
+        self.req_count = _compact(req_count)
+        self._requests = None
+        self._expanded = None
+        self._upper_bound = None
+
+    # ----------------------------------------------------------
+    def merge_requests(self):
+        """
+        Merge the requests for the same video from the same endpoint.
+
+        The numbers of requests are summed, and the merged requests are
+        sorted by endpoint, then by video.
+        This does not affect the score.
+
+        Returns:
+            None.
+        """
+        order = np.lexsort((self.req_video, self.req_endpoint))
+        req_video = self.req_video[order]
+        req_endpoint = self.req_endpoint[order]
+        firsts = np.flatnonzero(np.concatenate([
+            [True],
+            (np.diff(req_video.astype(np.int64)) != 0) |
+            (np.diff(req_endpoint.astype(np.int64)) != 0)]))
+        req_count = np.add.reduceat(
+            self.req_count[order].astype(np.int64), firsts) \
+            if len(firsts) else self.req_count[:0]
+        self.set_requests(
+            req_video[firsts], req_endpoint[firsts], req_count)
 
     # ----------------------------------------------------------
     def __str__(self):
@@ -102,27 +262,147 @@ class Network(object):
 
     # ----------------------------------------------------------
     @classmethod
-    def load(cls, filepath):
-        with open(filepath, 'r') as file:
-            num_videos, num_endpoints, num_requests, num_caches, cache_size = [
-                int(val) for val in file.readline().split()]
-            videos = np.array([int(v) for v in file.readline().split()])
-            endpoint_latencies = np.zeros(num_endpoints)
-            cache_latencies = np.zeros((num_endpoints, num_caches))
-            for i in range(num_endpoints):
-                endpoint_latencies[i], lines_to_read = [
-                    int(val) for val in file.readline().split()]
-                for j in range(lines_to_read):
-                    k, latency = [int(v) for v in file.readline().split()]
-                    cache_latencies[i, k] = latency
-            requests = []
-            for i in range(num_requests):
-                requests.append(
-                    tuple(int(val) for val in file.readline().split()))
+    def load(
+            cls, filepath, bulk=True, verbose=False, cache=True,
+            merge_requests=False):
+        """
+        Load the network from a `.in` file.
+
+        Args:
+            filepath (str): The input file path.
+            bulk (bool): Use the bulk parser.
+                If True, the whole file is tokenized at once in NumPy.
+                Otherwise, the file is parsed line by line.
+            verbose (bool): Report the parse throughput.
+            cache (bool): Use the binary sidecar of the input file.
+                The sidecar is a hidden directory next to the input file
+                (see `Network.save_bin()`), which is reused only if it
+                matches the size and the SHA-1 hash of the input file
+                (and the current binary format version).
+                Otherwise, it is (re-)generated after parsing.
+
+        Returns:
+            network (Network): The loaded network.
+        """
+        begin_time = time.time()
+        if cache:
+            cache_dirpath = _cache_dirpath(filepath)
+            key = _content_key(filepath)
+            meta = _read_meta(cache_dirpath)
+            if meta.get('key') == key and meta.get('version') == BIN_VERSION:
+                try:
+                    self = cls.load_bin(cache_dirpath)
+                except (OSError, ValueError) as e:
+                    # e.g. replaced while loading: parse the input instead
+                    print('W: Cannot map `{}`: {}'.format(cache_dirpath, e))
+                else:
+                    if merge_requests:
+                        self.merge_requests()
+                    if verbose:
+                        print('I: Mapped `{}` ({:.3f} s)'.format(
+                            os.path.basename(filepath),
+                            time.time() - begin_time), flush=True)
+                    return self
+        if bulk:
+            with open(filepath, 'rb') as file:
+                data = file.read()
+            args = _parse_bulk(data)
+            num_bytes = len(data)
+        else:
+            with open(filepath, 'r') as file:
+                args = _parse_lines(file)
+            num_bytes = os.path.getsize(filepath)
+        self = cls(*args)
+        if verbose:
+            elapsed = time.time() - begin_time
+            print('I: Parsed `{}` ({:.3f} MB in {:.3f} s, {:.1f} MB/s)'.format(
+                os.path.basename(filepath), num_bytes / 1e6, elapsed,
+                num_bytes / 1e6 / elapsed if elapsed > 0 else float('inf')),
+                flush=True)
+        if cache:
+            try:
+                self.save_bin(cache_dirpath, key)
+            except OSError as e:
+                print('W: Cannot write `{}`: {}'.format(cache_dirpath, e))
+        if merge_requests:
+            self.merge_requests()
+        return self
+
+    # ----------------------------------------------------------
+    @classmethod
+    def load_bin(cls, dirpath, mmap_mode='r'):
+        """
+        Load the network from its binary format.
+
+        Args:
+            dirpath (str): The directory written by `Network.save_bin()`.
+            mmap_mode (str|None): The memory-map mode of the arrays.
+                See `np.load()` for the accepted values.
+                If None, the arrays are read into memory.
+
+        Returns:
+            network (Network): The loaded network.
+        """
+        meta = _read_meta(dirpath)
+        if meta.get('version') != BIN_VERSION:
+            raise ValueError(
+                'Unsupported binary format in `{}`'.format(dirpath))
+        arrays = {
+            name: np.load(
+                os.path.join(dirpath, name + '.npy'), mmap_mode=mmap_mode)
+            for name in BIN_ARRAYS}
         self = cls(
-            videos, endpoint_latencies, cache_size, cache_latencies, requests)
+            arrays['videos'], arrays['endpoint_latencies'],
+            meta['cache_size'], None, None,
+            (arrays['link_offsets'], arrays['link_caches'],
+             arrays['link_latencies']),
+            meta['num_caches'])
+        self.set_requests(
+            arrays['req_video'], arrays['req_endpoint'], arrays['req_count'])
         return self
 
+    # ----------------------------------------------------------
+    def save_bin(self, dirpath, key=None):
+        """
+        Save the network in its binary format.
+
+        This is a directory of raw `.npy` arrays (which can be memory-mapped)
+        plus a small `meta.json`.
+        The directory is written aside and then swapped in by renaming, so
+        that it is never seen partially written (readers racing with the
+        swap fall back to parsing, see `Network.load()`).
+
+        Args:
+            dirpath (str): The output directory path.
+            key (Any): Information identifying the source of the network.
+
+        Returns:
+            None.
+        """
+        arrays = {
+            'videos': self.videos,
+            'endpoint_latencies': self.endpoint_latencies,
+            'link_offsets': self.link_offsets,
+            'link_caches': self.link_caches,
+            'link_latencies': self.link_latencies,
+            'req_video': self.req_video,
+            'req_endpoint': self.req_endpoint,
+            'req_count': self.req_count}
+        meta = dict(
+            version=BIN_VERSION, cache_size=int(self.cache_size),
+            num_caches=int(self.num_caches), key=key)
+        tmp_dirpath = '{}.{}.tmp'.format(dirpath, os.getpid())
+        if os.path.isdir(tmp_dirpath):
+            shutil.rmtree(tmp_dirpath)
+        os.makedirs(tmp_dirpath)
+        for name in BIN_ARRAYS:
+            np.save(
+                os.path.join(tmp_dirpath, name + '.npy'),
+                np.ascontiguousarray(arrays[name]))
+        with open(os.path.join(tmp_dirpath, 'meta.json'), 'w') as file:
+            json.dump(meta, file)
+        _replace_dir(tmp_dirpath, dirpath)
+
     # ----------------------------------------------------------
     def save(self, filepath):
         with open(filepath, 'w+') as file:
@@ -147,11 +427,191 @@ class Network(object):
             # for i in range(num_requests):
             #     requests.append([int(val) for val in file.readline().split()])
 
+    # ----------------------------------------------------------
+    @property
+    def expanded(self):
+        """
+        The requests expanded over the connections of their endpoint.
+
+        Only requests from connected endpoints are included.
+        The expansion is computed on first access and cached.
+
+        Returns:
+            expanded (dict): The expanded requests.
+                - `index`: the flat (cache, video) index in the placement
+                  matrix, for each request-connection pair;
+                - `latencies`: the latency, for each pair;
+                - `starts`: the first pair of each request;
+                - `requests`: the index of each request in `req_*`;
+                - `max_latencies`: the endpoint latency, for each request;
+                - `counts`: the number of requests, for each request;
+                - `num_tot`: the total number of requests (all endpoints).
+        """
+        if self._expanded is None:
+            degrees = np.diff(self.link_offsets)[self.req_endpoint]
+            mask = degrees > 0
+            endpoints = self.req_endpoint[mask]
+            degrees = degrees[mask]
+            starts = np.cumsum(degrees) - degrees
+            links = np.repeat(self.link_offsets[endpoints] - starts, degrees) \
+                + np.arange(np.sum(degrees))
+            index_dtype = np.int32 \
+                if self.num_caches * self.num_videos < 2 ** 31 else np.int64
+            index = self.link_caches[links].astype(index_dtype) * \
+                index_dtype(self.num_videos) + \
+                np.repeat(self.req_video[mask], degrees).astype(index_dtype)
+            self._expanded = dict(
+                index=index,
+                latencies=_compact(self.link_latencies[links]),
+                starts=starts,
+                requests=np.flatnonzero(mask),
+                max_latencies=self.endpoint_latencies[endpoints].astype(
+                    np.int64),
+                counts=self.req_count[mask].astype(np.int64),
+                num_tot=int(np.sum(self.req_count, dtype=np.int64)))
+        return self._expanded
+
+    # ----------------------------------------------------------
+    def upper_bound(self, chunk_size=2 ** 20):
+        """
+        Compute an upper bound of the score of any valid caching.
+
+        This is the smaller of two relaxations:
+         - without capacity: each request is served by its fastest cache;
+         - without interactions: each cache holds the fractional knapsack
+           of the savings of its videos alone (as if the other caches were
+           empty), which is never exceeded since the saving of a video in a
+           cache can only decrease when other videos are cached.
+        The bound is computed on first use and cached.
+        The requests are expanded over their connections in chunks, so that
+        `Network.expanded` is not needed.
+
+        Args:
+            chunk_size (int): The approximate number of request-connection
+                pairs expanded at once.
+
+        Returns:
+            score (int): The upper bound of the score.
+        """
+        if self._upper_bound is None:
+            num_links = np.diff(self.link_offsets)
+            max_degree = int(np.max(num_links)) if len(num_links) else 0
+            step = max(1, chunk_size // max(1, max_degree))
+            relaxed = 0
+            gains = np.zeros(self.num_caches * self.num_videos)
+            for first in range(0, len(self.req_endpoint), step):
+                last = first + step
+                endpoints = self.req_endpoint[first:last]
+                degrees = num_links[endpoints]
+                starts = np.cumsum(degrees) - degrees
+                links = np.repeat(self.link_offsets[endpoints] - starts,
+                                  degrees) + np.arange(np.sum(degrees))
+                savings = np.maximum(np.repeat(
+                    self.endpoint_latencies[endpoints].astype(np.int64),
+                    degrees) - self.link_latencies[links], 0) * np.repeat(
+                    self.req_count[first:last].astype(np.int64), degrees)
+                # the connections are sorted by ascending latency
+                relaxed += int(np.sum(savings[starts[degrees > 0]]))
+                gains += np.bincount(
+                    self.link_caches[links].astype(np.int64) *
+                    self.num_videos +
+                    np.repeat(self.req_video[first:last], degrees),
+                    savings, minlength=len(gains))
+            gains = gains.reshape(self.num_caches, self.num_videos)
+            sizes = self.videos.astype(np.float64)
+            order = np.argsort(-gains / sizes, axis=1, kind='stable')
+            gains = np.take_along_axis(gains, order, axis=1)
+            starts = np.cumsum(sizes[order], axis=1) - sizes[order]
+            fractions = np.clip(
+                (self.cache_size - starts) / sizes[order], 0, 1)
+            fractional = np.sum(gains * fractions)
+            num_tot = int(np.sum(self.req_count, dtype=np.int64))
+            self._upper_bound = int(
+                min(relaxed, fractional) / num_tot * 1000) if num_tot else 0
+        return self._upper_bound
+
+    # ----------------------------------------------------------
+    def gap(self, score):
+        """
+        Compute the relative gap of a score from the upper bound.
+
+        Args:
+            score (int): The score.
+
+        Returns:
+            gap (float): The gap, as a fraction of the upper bound.
+                The score is optimal if this is 0 (the converse may not hold).
+        """
+        upper_bound = self.upper_bound()
+        return (upper_bound - score) / upper_bound if upper_bound else 0.0
+
     # ----------------------------------------------------------
     def score(self, caching):
-        return _score(
-            caching.caches, self.requests, self.cache_latencies,
-            self.endpoint_latencies)
+        return self.score_placement(
+            _placement(caching, self.num_videos, self.num_caches))
+
+    # ----------------------------------------------------------
+    def score_placement(self, placement, engine=None):
+        """
+        Compute the score of one or more placements.
+
+        Args:
+            placement (np.ndarray): The placement matrix.
+                Must have shape (num_caches, num_videos) or
+                (num_solutions, num_caches, num_videos).
+            engine (str|None): The scoring engine.
+                If None, `SCORE_ENGINE` is used.
+                See `set_score_engine()` for more info.
+
+        Returns:
+            score (int|np.ndarray): The score(s).
+                For each placement, this is the same integer as `_score`.
+        """
+        num_tot = int(np.sum(self.req_count, dtype=np.int64))
+        savings = self.savings(placement, engine)
+        scores = np.array(
+            [int(saving / num_tot * 1000) for saving in savings.tolist()])
+        return int(scores[0]) if placement.ndim == 2 else scores
+
+    # ----------------------------------------------------------
+    def savings(self, placement, engine=None):
+        """
+        Compute the total latency saving of one or more placements.
+
+        Args:
+            placement (np.ndarray): The placement matrix.
+                Must have shape (num_caches, num_videos) or
+                (num_solutions, num_caches, num_videos).
+            engine (str|None): The scoring engine.
+                If None, `SCORE_ENGINE` is used.
+                See `set_score_engine()` for more info.
+
+        Returns:
+            savings (np.ndarray[int]): The saving of each placement.
+        """
+        global _PARALLEL_PID
+        engine = _check_engine(engine if engine else SCORE_ENGINE)
+        if engine == 'numba_par':
+            if _PARALLEL_PID is None:
+                _PARALLEL_PID = os.getpid()
+            elif _PARALLEL_PID != os.getpid():
+                engine = 'numba'
+        if engine in ('numba', 'numba_par'):
+            kernel = _savings_numba if engine == 'numba_par' \
+                else _savings_numba_serial
+            return kernel(
+                np.ascontiguousarray(placement.reshape(
+                    -1, self.num_caches, self.num_videos)),
+                self.req_video, self.req_endpoint,
+                self.req_count.astype(np.int64),
+                self.link_offsets, self.link_caches,
+                self.link_latencies.astype(np.int64),
+                self.endpoint_latencies.astype(np.int64),
+                _num_chunks(self.num_requests))
+        else:
+            return _savings_numpy(
+                placement.reshape(-1, self.num_caches * self.num_videos),
+                **self.expanded)
 
 
 # ======================================================================
@@ -219,30 +679,32 @@ class Caching(object):
 
     # ----------------------------------------------------------
     def save(self, filepath):
-        with open(filepath, 'w+') as file:
+        # write to a temporary file first, so that readers never see a
+        # partially written file
+        tmp_filepath = '{}.{}.tmp'.format(filepath, os.getpid())
+        with open(tmp_filepath, 'w+') as file:
             file.write(str(len(self.caches)) + '\n')
             for i, server in enumerate(self.caches):
                 file.write(
                     '{} {}\n'.format(i, ' '.join([str(val) for val in server])))
+        os.replace(tmp_filepath, filepath)
 
     # ----------------------------------------------------------
     def validate(self, videos, cache_size):
-        is_valid = True
-        for cached_videos in self.caches:
-            if cached_videos:
-                avail_cache = cache_size
-                for cached_video in cached_videos:
-                    avail_cache -= videos[cached_video]
-                is_valid = is_valid and (avail_cache >= 0)
-            if not is_valid:
-                break
-        return is_valid
+        # the loads as one sparse product of the contents and the sizes
+        lengths = [len(cached_videos) for cached_videos in self.caches]
+        cached = np.fromiter(
+            itertools.chain.from_iterable(self.caches), dtype=np.int64,
+            count=sum(lengths))
+        loads = np.bincount(
+            np.repeat(np.arange(len(lengths)), lengths),
+            np.asarray(videos, dtype=np.int64)[cached].astype(np.float64),
+            minlength=len(lengths))
+        return bool(np.all(loads <= cache_size))
 
     # ----------------------------------------------------------
     def score(self, network):
-        return _score(
-            self.caches, network.requests, network.cache_latencies,
-            network.endpoint_latencies)
+        return network.score(self)
 
     # ----------------------------------------------------------
     def clear(self):
@@ -265,44 +727,932 @@ class Caching(object):
 
 
 # ======================================================================
-@jit
-def _score(caches, requests, cache_latencies, endpoint_latencies):
+class CachingMatrix(Caching):
+    def __init__(
+            self,
+            caches=None,
+            num_videos=None):
+        """
+        Caching of videos as a boolean matrix.
+
+        This behaves like `Caching`, but the videos contained in the caching
+        servers are stored in a single (num_caches, num_videos) boolean
+        array (`placement`).
+        For pickling, the array is bit-packed.
+        The `caches` attribute gives access to the rows as sets.
+
+        Args:
+            caches (list[set]|np.ndarray|int): The videos in each cache.
+                If np.ndarray, this is the placement matrix (not copied).
+                If int, this is the number of caches (all empty).
+                Otherwise, the videos contained in each caching server.
+            num_videos (int|None): The number of videos.
+                If None, this is inferred from `caches`, if possible.
+        """
+        if isinstance(caches, np.ndarray):
+            self.placement = caches.astype(bool, copy=False)
+        else:
+            try:
+                iter(caches)
+            except TypeError:
+                if caches > 0 and num_videos is not None:
+                    self.placement = np.zeros((caches, num_videos), dtype=bool)
+                else:
+                    raise AttributeError(
+                        'Either `caches` or `num_caches` and `num_videos` '
+                        'must be supplied!')
+            else:
+                caches = [list(videos) for videos in caches]
+                if num_videos is None:
+                    num_videos = 1 + max(
+                        [max(videos) for videos in caches if videos] + [-1])
+                self.placement = np.zeros(
+                    (len(caches), num_videos), dtype=bool)
+                self.caches = caches
+
+    # ----------------------------------------------------------
+    @property
+    def num_caches(self):
+        return self.placement.shape[0]
+
+    # ----------------------------------------------------------
+    @property
+    def num_videos(self):
+        return self.placement.shape[1]
+
+    # ----------------------------------------------------------
+    @property
+    def caches(self):
+        return _CacheRows(self.placement)
+
+    # ----------------------------------------------------------
+    @caches.setter
+    def caches(self, value):
+        if isinstance(value, np.ndarray):
+            self.placement = value.astype(bool, copy=False)
+        else:
+            cache_ids = np.repeat(
+                np.arange(len(value)), [len(videos) for videos in value])
+            video_ids = np.fromiter(
+                (video for videos in value for video in videos),
+                dtype=np.int64, count=len(cache_ids))
+            placement = np.zeros((len(value), self.num_videos), dtype=bool)
+            placement[cache_ids, video_ids] = True
+            self.placement = placement
+
+    # ----------------------------------------------------------
+    @property
+    def packed(self):
+        return np.packbits(self.placement, axis=-1)
+
+    # ----------------------------------------------------------
+    def __getstate__(self):
+        return dict(packed=self.packed, num_videos=self.num_videos)
+
+    # ----------------------------------------------------------
+    def __setstate__(self, state):
+        self.placement = np.unpackbits(
+            state['packed'], axis=-1, count=state['num_videos']).astype(bool)
+
+    # ----------------------------------------------------------
+    def __deepcopy__(self, memo):
+        return self.__class__(self.placement.copy())
+
+    # ----------------------------------------------------------
+    @classmethod
+    def from_packed(cls, packed, num_videos):
+        return cls(np.unpackbits(
+            packed, axis=-1, count=num_videos).astype(bool))
+
+    # ----------------------------------------------------------
+    @classmethod
+    def from_caching(cls, caching, num_videos):
+        if isinstance(caching, CachingMatrix):
+            return cls(caching.placement.copy())
+        else:
+            return cls(caching.caches, num_videos)
+
+    # ----------------------------------------------------------
+    def to_caching(self):
+        return Caching([set(videos) for videos in self.caches])
+
+    # ----------------------------------------------------------
+    @classmethod
+    def load(cls, filepath, num_videos=None):
+        return cls(Caching.load(filepath).caches, num_videos)
+
+    # ----------------------------------------------------------
+    def validate(self, videos, cache_size):
+        return not np.any(overflows(self.placement, videos, cache_size))
+
+    # ----------------------------------------------------------
+    def clear(self):
+        self.placement[:] = False
+
+
+# ======================================================================
+class _CacheRows(object):
+    """
+    Sequence of sets backed by the rows of a boolean placement matrix.
+    """
+
+    def __init__(self, placement):
+        self._placement = placement
+
+    def __len__(self):
+        return self._placement.shape[0]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(len(self))[i]]
+        return _CacheRow(self._placement[i])
+
+    def __setitem__(self, i, videos):
+        row = self._placement[i]
+        row[:] = False
+        row[list(videos)] = True
+
+    def __iter__(self):
+        return (_CacheRow(row) for row in self._placement)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+# ======================================================================
+class _CacheRow(collections.abc.MutableSet):
+    """
+    Set of videos backed by a row of a boolean placement matrix.
+    """
+
+    def __init__(self, row):
+        self._row = row
+
+    def __contains__(self, video):
+        return 0 <= video < len(self._row) and bool(self._row[video])
+
+    def __iter__(self):
+        return iter(np.flatnonzero(self._row).tolist())
+
+    def __len__(self):
+        return int(np.count_nonzero(self._row))
+
+    def add(self, video):
+        self._row[video] = True
+
+    def discard(self, video):
+        if 0 <= video < len(self._row):
+            self._row[video] = False
+
+    def __copy__(self):
+        return set(self)
+
+    def __deepcopy__(self, memo):
+        return set(self)
+
+    def __repr__(self):
+        return repr(set(self))
+
+
+# ======================================================================
+class Evaluator(object):
+    def __init__(
+            self,
+            network,
+            caching=None):
+        """
+        Incremental score evaluation for single-video moves.
+
+        For each request, this keeps the best and the second best latency
+        (and the cache serving the best latency).
+        The score change of adding or removing a video from a cache only
+        depends on the requests for that video, from the endpoints
+        connected to that cache.
+
+        Args:
+            network (Network): The network.
+            caching (Caching|None): The initial caching.
+                If not None, it is updated by `Evaluator.apply()`.
+                Otherwise, an empty caching is assumed.
+        """
+        self.network = network
+        self.caching = caching
+        num_caches, num_videos = network.num_caches, network.num_videos
+        self.placement = _placement(caching, num_videos).copy() \
+            if caching is not None \
+            else np.zeros((num_caches, num_videos), dtype=bool)
+        self.sizes = np.asarray(network.videos, dtype=np.int64)
+        self.free = network.cache_size - self.placement @ self.sizes
+        self.latencies = network.cache_latencies.astype(np.int64)
+        self.max_latencies = network.endpoint_latencies[
+            network.req_endpoint].astype(np.int64)
+        self.counts = network.req_count.astype(np.int64)
+        self.endpoints = network.req_endpoint.astype(np.int64)
+        self.num_tot = int(np.sum(self.counts))
+        # group requests by video
+        self.video_requests = np.argsort(network.req_video, kind='stable')
+        self.video_offsets = np.zeros(num_videos + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(network.req_video, minlength=num_videos),
+            out=self.video_offsets[1:])
+        # best and second best latency of each request
+        self.best = self.max_latencies.copy()
+        self.second = self.max_latencies.copy()
+        self.best_cache = np.full(network.num_requests, -1, dtype=np.int64)
+        expanded = network.expanded
+        flat = self.placement.reshape(-1)
+        pairs = np.flatnonzero(flat[expanded['index']])
+        requests = np.searchsorted(expanded['starts'], pairs, side='right') - 1
+        ranks = np.arange(len(pairs)) - np.searchsorted(requests, requests)
+        for rank, latencies in ((0, self.best), (1, self.second)):
+            mask = ranks == rank
+            i = expanded['requests'][requests[mask]]
+            latencies[i] = np.minimum(
+                latencies[i], expanded['latencies'][pairs[mask]])
+            if rank == 0:
+                caches = expanded['index'][pairs[mask]] // num_videos
+                self.best_cache[i] = np.where(
+                    latencies[i] < self.max_latencies[i], caches, -1)
+        self.saving = int(np.sum((self.max_latencies - self.best) * self.counts))
+        self._cache_pairs = None
+
+    # ----------------------------------------------------------
+    @property
+    def score(self):
+        return int(self.saving / self.num_tot * 1000)
+
+    # ----------------------------------------------------------
+    def score_of(self, delta):
+        """
+        Compute the score after a change in the total saving.
+
+        Args:
+            delta (int): The change in the total saving.
+
+        Returns:
+            score (int): The score.
+        """
+        return int((self.saving + delta) / self.num_tot * 1000)
+
+    # ----------------------------------------------------------
+    def requests_of(self, video):
+        return self.video_requests[
+            self.video_offsets[video]:self.video_offsets[video + 1]]
+
+    # ----------------------------------------------------------
+    def fits(self, cache, video):
+        return self.sizes[video] <= self.free[cache]
+
+    # ----------------------------------------------------------
+    def delta_add(self, cache, video):
+        """
+        Compute the saving change of adding a video to a cache.
+
+        Args:
+            cache (int): The cache ID.
+            video (int): The video ID.
+
+        Returns:
+            delta (int): The change in the total saving (non-negative).
+                The capacity of the cache is not checked.
+        """
+        if self.placement[cache, video]:
+            return 0
+        requests = self.requests_of(video)
+        latencies = self.latencies[self.endpoints[requests], cache]
+        gains = self.best[requests] - latencies
+        gains[latencies == 0] = 0
+        return int(np.sum(np.maximum(gains, 0) * self.counts[requests]))
+
+    # ----------------------------------------------------------
+    def gains(self):
+        """
+        Compute the saving change of adding each video to each cache.
+
+        Returns:
+            gains (np.ndarray): The (num_caches, num_videos) saving changes.
+                These are the same as `Evaluator.delta_add()` for all pairs.
+        """
+        expanded = self.network.expanded
+        degrees = np.diff(np.append(expanded['starts'], len(expanded['index'])))
+        requests = np.repeat(expanded['requests'], degrees)
+        weights = np.maximum(self.best[requests] - expanded['latencies'], 0) * \
+            self.counts[requests]
+        gains = np.bincount(
+            expanded['index'], weights,
+            minlength=self.placement.size).reshape(self.placement.shape)
+        return np.rint(gains).astype(np.int64)
+
+    # ----------------------------------------------------------
+    def cache_gains(self, cache):
+        """
+        Compute the saving of each video in a cache, given the other caches.
+
+        This is the saving change of adding each video to the cache, as if
+        the cache were empty and the other caches were unchanged.
+        Since the requests for different videos are independent, the saving
+        of any content of the cache is the sum of the savings of its videos.
+
+        Args:
+            cache (int): The cache ID.
+
+        Returns:
+            gains (np.ndarray): The (num_videos,) savings.
+        """
+        if self._cache_pairs is None:
+            # group the expanded requests by cache
+            expanded = self.network.expanded
+            degrees = np.diff(
+                np.append(expanded['starts'], len(expanded['index'])))
+            caches, videos = np.divmod(
+                expanded['index'], self.network.num_videos)
+            order = np.argsort(caches, kind='stable')
+            offsets = np.zeros(self.network.num_caches + 1, dtype=np.int64)
+            np.cumsum(
+                np.bincount(caches, minlength=self.network.num_caches),
+                out=offsets[1:])
+            self._cache_pairs = (
+                offsets, videos[order],
+                np.repeat(expanded['requests'], degrees)[order],
+                expanded['latencies'][order])
+        offsets, videos, requests, latencies = self._cache_pairs
+        first, last = offsets[cache], offsets[cache + 1]
+        requests = requests[first:last]
+        best = np.where(
+            self.best_cache[requests] == cache,
+            self.second[requests], self.best[requests])
+        weights = np.maximum(best - latencies[first:last], 0) * \
+            self.counts[requests]
+        gains = np.bincount(
+            videos[first:last], weights, minlength=self.network.num_videos)
+        return np.rint(gains).astype(np.int64)
+
+    # ----------------------------------------------------------
+    def video_gains(self, video):
+        """
+        Compute the saving change of adding a video to each cache.
+
+        Args:
+            video (int): The video ID.
+
+        Returns:
+            gains (np.ndarray): The (num_caches,) saving changes.
+                These are the same as `Evaluator.delta_add()` for all caches.
+        """
+        requests = self.requests_of(video)
+        latencies = self.latencies[self.endpoints[requests]]
+        gains = self.best[requests, None] - latencies
+        gains[latencies == 0] = 0
+        gains = np.maximum(gains, 0).T @ self.counts[requests]
+        gains[self.placement[:, video]] = 0
+        return gains
+
+    # ----------------------------------------------------------
+    def delta_remove(self, cache, video):
+        """
+        Compute the saving change of removing a video from a cache.
+
+        Args:
+            cache (int): The cache ID.
+            video (int): The video ID.
+
+        Returns:
+            delta (int): The change in the total saving (non-positive).
+        """
+        if not self.placement[cache, video]:
+            return 0
+        requests = self.requests_of(video)
+        requests = requests[self.best_cache[requests] == cache]
+        return -int(np.sum(
+            (self.second[requests] - self.best[requests]) *
+            self.counts[requests]))
+
+    # ----------------------------------------------------------
+    def apply(self, cache, video, add=True):
+        """
+        Add or remove a video from a cache and update the state.
+
+        Args:
+            cache (int): The cache ID.
+            video (int): The video ID.
+            add (bool): Add the video if True, remove it otherwise.
+
+        Returns:
+            delta (int): The change in the total saving.
+        """
+        if bool(self.placement[cache, video]) == add:
+            return 0
+        delta = self.delta_add(cache, video) if add \
+            else self.delta_remove(cache, video)
+        self.placement[cache, video] = add
+        self.free[cache] += -self.sizes[video] if add else self.sizes[video]
+        if self.caching is not None:
+            if add:
+                self.caching.caches[cache].add(video)
+            else:
+                self.caching.caches[cache].discard(video)
+        self._refresh(video)
+        self.saving += delta
+        return delta
+
+    # ----------------------------------------------------------
+    def _refresh(self, video):
+        requests = self.requests_of(video)
+        if not len(requests):
+            return
+        caches = np.flatnonzero(self.placement[:, video])
+        max_latencies = self.max_latencies[requests]
+        latencies = self.latencies[self.endpoints[requests]][:, caches]
+        latencies = np.where(
+            (latencies > 0) & (latencies < max_latencies[:, None]),
+            latencies, max_latencies[:, None])
+        latencies = np.concatenate(
+            [latencies, max_latencies[:, None], max_latencies[:, None]],
+            axis=1)
+        order = np.argsort(latencies, axis=1, kind='stable')[:, :2]
+        best, second = np.take_along_axis(latencies, order, axis=1).T
+        self.best[requests] = best
+        self.second[requests] = second
+        best_caches = np.append(caches, [-1, -1])[order[:, 0]]
+        self.best_cache[requests] = np.where(
+            best < max_latencies, best_caches, -1)
+
+
+# ======================================================================
+def _placement(caching, num_videos, num_caches=None):
+    # missing videos (and caches, if `num_caches` is given) are not cached
+    if isinstance(caching, CachingMatrix):
+        placement = caching.placement
+    else:
+        placement = CachingMatrix(caching.caches, num_videos).placement
+    missing_caches = max(0, (num_caches or 0) - placement.shape[0])
+    missing_videos = max(0, num_videos - placement.shape[1])
+    if missing_caches or missing_videos:
+        placement = np.pad(
+            placement, ((0, missing_caches), (0, missing_videos)))
+    return placement
+
+
+# ======================================================================
+def knapsack(values, sizes, capacity, max_capacity=None):
+    """
+    Solve the 0/1 knapsack problem with dynamic programming.
+
+    The table is filled one item at a time, vectorized over the capacity,
+    and the choices are stored as bits for the reconstruction.
+    Items with non-positive value or larger than the capacity are ignored.
+
+    Args:
+        values (np.ndarray): The value of each item (e.g. the score gains).
+        sizes (np.ndarray): The size of each item (e.g. `network.videos`).
+        capacity (int): The capacity (e.g. `network.cache_size`).
+        max_capacity (int|None): The maximum capacity of the table.
+            If `capacity` is larger, sizes and capacity are divided by a
+            common factor, rounding sizes up and the capacity down, and
+            the space left is then filled greedily.
+            The result is always feasible, but may be suboptimal.
+            If None, the problem is solved exactly.
+
+    Returns:
+        items (np.ndarray): The sorted indexes of the selected items.
+    """
+    values = np.asarray(values)
+    sizes = np.asarray(sizes, dtype=np.int64)
+    items = np.flatnonzero((values > 0) & (sizes <= capacity))
+    total_capacity = capacity
+    scale = -(-capacity // max_capacity) \
+        if max_capacity is not None and capacity > max_capacity else 1
+    weights = -(-sizes[items] // scale)
+    capacity = min(capacity // scale, int(np.sum(weights)))
+    table = np.zeros(capacity + 1, dtype=values.dtype)
+    chosen = np.zeros((len(items), capacity // 8 + 1), dtype=np.uint8)
+    taken = np.zeros(capacity + 1, dtype=bool)
+    for i, (weight, value) in enumerate(
+            zip(weights.tolist(), values[items].tolist())):
+        candidates = table[:capacity + 1 - weight] + value
+        taken[:weight] = False
+        taken[weight:] = candidates > table[weight:]
+        table[weight:][taken[weight:]] = candidates[taken[weight:]]
+        chosen[i] = np.packbits(taken)
+    # reconstruct the choices
+    selected = []
+    for i in range(len(items) - 1, -1, -1):
+        if chosen[i, capacity >> 3] >> (7 - (capacity & 7)) & 1:
+            selected.append(items[i])
+            capacity -= weights[i]
+    selected = np.array(selected[::-1], dtype=np.int64)
+    if scale > 1:
+        # use the space lost to rounding, by decreasing value density
+        free = total_capacity - int(np.sum(sizes[selected]))
+        unselected = np.setdiff1d(items, selected)
+        added = []
+        for i in unselected[np.argsort(
+                -values[unselected] / sizes[unselected], kind='stable')]:
+            if sizes[i] <= free:
+                added.append(i)
+                free -= sizes[i]
+        selected = np.union1d(selected, np.array(added, dtype=np.int64))
+    return selected
+
+
+# ======================================================================
+def cache_loads(placements, videos, chunk_size=2 ** 24):
+    """
+    Compute the used capacity of the caches of one or more placements.
+
+    The loads are matrix-vector products of the placements with the video
+    sizes: boolean placements are multiplied in chunks of rows, while for
+    packed placements the sizes of each byte value are tabulated, so that
+    they do not need to be unpacked.
+
+    Args:
+        placements (np.ndarray): The (..., num_caches, num_videos) boolean
+            placements, or the placements packed along the videos with
+            `np.packbits()` (with dtype uint8).
+        videos (np.ndarray): The size of each video.
+        chunk_size (int): The maximum number of elements per product.
+
+    Returns:
+        loads (np.ndarray): The (..., num_caches) used capacity.
+    """
+    placements = np.asarray(placements)
+    sizes = np.asarray(videos, dtype=np.int64)
+    rows = placements.reshape(-1, placements.shape[-1])
+    if placements.dtype == np.uint8:
+        num_bytes = rows.shape[1]
+        padded = np.zeros(num_bytes * 8, dtype=np.int64)
+        padded[:len(sizes)] = sizes
+        bits = np.unpackbits(
+            np.arange(256, dtype=np.uint8)[:, None], axis=1).astype(np.int64)
+        table = padded.reshape(num_bytes, 8) @ bits.T
+        if table.max(initial=0) < 2 ** 31:
+            table = table.astype(np.int32)
+        table = table.ravel()
+        offsets = np.arange(num_bytes) * 256
+        loads = np.zeros(len(rows), dtype=np.int64)
+        step = max(1, chunk_size // max(1, num_bytes))
+        for i in range(0, len(rows), step):
+            loads[i:i + step] = np.sum(
+                np.take(table, rows[i:i + step] + offsets), axis=1,
+                dtype=np.int64)
+    else:
+        # exact in float64 up to 2 ** 53
+        loads = np.zeros(len(rows), dtype=np.int64)
+        step = max(1, chunk_size // max(1, rows.shape[1]))
+        for i in range(0, len(rows), step):
+            loads[i:i + step] = np.rint(
+                rows[i:i + step].astype(np.float64) @ sizes.astype(np.float64))
+    return loads.reshape(placements.shape[:-1])
+
+
+# ======================================================================
+def overflows(placements, videos, cache_size):
+    """
+    Compute the overflow of the caches of one or more placements.
+
+    Args:
+        placements (np.ndarray): The (..., num_caches, num_videos) boolean
+            or packed placements. See `cache_loads()` for more info.
+        videos (np.ndarray): The size of each video.
+        cache_size (int): The capacity of each cache.
+
+    Returns:
+        overflow (np.ndarray): The (..., num_caches) used capacity in excess
+            of `cache_size` (0 for valid caches).
+            A placement is valid if all its caches have zero overflow.
+    """
+    return np.maximum(cache_loads(placements, videos) - cache_size, 0)
+
+
+# ======================================================================
+def _cache_dirpath(filepath):
+    dirpath, filename = os.path.split(filepath)
+    return os.path.join(dirpath, '.' + filename + '.cache')
+
+
+# ======================================================================
+def _content_key(filepath, block_size=2 ** 20):
+    hasher = hashlib.sha1()
+    with open(filepath, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            hasher.update(block)
+    return '{}:{}'.format(os.path.getsize(filepath), hasher.hexdigest())
+
+
+# ======================================================================
+def _replace_dir(tmp_dirpath, dirpath):
+    # move the old directory aside first, so that `dirpath` is only missing
+    # between two renames (and never partially removed)
+    old_dirpath = '{}.{}.old'.format(dirpath, os.getpid())
+    try:
+        os.rename(dirpath, old_dirpath)
+    except OSError:
+        old_dirpath = None
+    try:
+        os.rename(tmp_dirpath, dirpath)
+    except OSError:
+        # someone else got there first
+        shutil.rmtree(tmp_dirpath, ignore_errors=True)
+    if old_dirpath:
+        shutil.rmtree(old_dirpath, ignore_errors=True)
+
+
+# ======================================================================
+def _read_meta(dirpath):
+    try:
+        with open(os.path.join(dirpath, 'meta.json'), 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+# ======================================================================
+def _parse_lines(file):
+    num_videos, num_endpoints, num_requests, num_caches, cache_size = [
+        int(val) for val in file.readline().split()]
+    videos = np.array([int(v) for v in file.readline().split()])
+    endpoint_latencies = np.zeros(num_endpoints)
+    cache_latencies = np.zeros((num_endpoints, num_caches))
+    for i in range(num_endpoints):
+        endpoint_latencies[i], lines_to_read = [
+            int(val) for val in file.readline().split()]
+        for j in range(lines_to_read):
+            k, latency = [int(v) for v in file.readline().split()]
+            cache_latencies[i, k] = latency
+    requests = []
+    for i in range(num_requests):
+        requests.append(
+            tuple(int(val) for val in file.readline().split()))
+    return videos, endpoint_latencies, cache_size, cache_latencies, requests
+
+
+# ======================================================================
+def _parse_bulk(data):
+    tokens = np.fromstring(data, dtype=np.int64, sep=' ')
+    num_videos, num_endpoints, num_requests, num_caches, cache_size = [
+        int(val) for val in tokens[:5]]
+    pos = 5
+    videos = tokens[pos:pos + num_videos].copy()
+    pos += num_videos
+    # only the endpoint headers are visited: each one gives the jump
+    endpoint_latencies = np.zeros(num_endpoints)
+    starts = np.zeros(num_endpoints, dtype=np.int64)
+    degrees = np.zeros(num_endpoints, dtype=np.int64)
+    for i in range(num_endpoints):
+        endpoint_latencies[i], degrees[i] = tokens[pos:pos + 2]
+        starts[i] = pos + 2
+        pos += 2 + 2 * int(degrees[i])
+    rows = np.repeat(np.arange(num_endpoints), degrees)
+    firsts = np.repeat(np.cumsum(degrees) - degrees, degrees)
+    positions = np.repeat(starts, degrees) + \
+        2 * (np.arange(len(rows)) - firsts)
+    links = _links_from_pairs(
+        num_endpoints, rows, tokens[positions], tokens[positions + 1])
+    if len(tokens) < pos + 3 * num_requests:
+        raise ValueError('Truncated input: {} values missing!'.format(
+            pos + 3 * num_requests - len(tokens)))
+    requests = tokens[pos:pos + 3 * num_requests].reshape(-1, 3)
+    return (
+        videos, endpoint_latencies, cache_size, None, requests, links,
+        num_caches)
+
+
+# ======================================================================
+def _compact(values):
+    values = np.asarray(values)
+    max_value = int(np.max(values)) if len(values) else 0
+    for dtype in (np.int8, np.int16, np.int32):
+        if max_value <= np.iinfo(dtype).max:
+            break
+    else:
+        dtype = np.int64
+    return values if values.dtype == dtype else values.astype(dtype)
+
+
+# ======================================================================
+def _links_from_pairs(num_endpoints, endpoints, caches, latencies):
+    # 0 latency means not connected (as in the dense form)
+    mask = latencies > 0
+    endpoints, caches, latencies = \
+        endpoints[mask], caches[mask], latencies[mask]
+    order = np.lexsort((latencies, endpoints))
+    offsets = np.zeros(num_endpoints + 1, dtype=np.int64)
+    np.cumsum(
+        np.bincount(endpoints, minlength=num_endpoints), out=offsets[1:])
+    return (
+        offsets, caches[order].astype(np.int32),
+        latencies[order].astype(np.int64))
+
+
+# ======================================================================
+def set_score_engine(engine):
+    """
+    Set the default scoring engine.
+
+    Args:
+        engine (str): The scoring engine.
+            Accepted values are:
+             - 'numpy': vectorized NumPy (see `_savings_numpy()`);
+             - 'numba': compiled kernel (see `_savings_numba_serial()`);
+             - 'numba_par': compiled multi-threaded kernel
+               (see `_savings_numba()`).
+            If Numba is not available, 'numba*' fall back to 'numpy'.
+            Note that processes should not be forked after 'numba_par'
+            has been used: the Numba thread pool is not fork-safe and the
+            parent may hang on exit. Forked processes automatically use
+            'numba' instead.
+            The initial default can be set with the `QUARKBALL_SCORE_ENGINE`
+            environment variable.
+
+    Returns:
+        None.
+    """
+    global SCORE_ENGINE
+    SCORE_ENGINE = _check_engine(engine)
+
+
+# ======================================================================
+def _check_engine(engine):
+    if engine not in SCORE_ENGINES:
+        raise ValueError('Unknown scoring engine `{}`'.format(engine))
+    elif engine.startswith('numba') and not HAS_NUMBA:
+        engine = 'numpy'
+    return engine
+
+
+# ======================================================================
+def _num_chunks(num_requests, chunk_size=4096):
+    return max(1, (num_requests + chunk_size - 1) // chunk_size)
+
+
+# ======================================================================
+@njit(nogil=True, cache=True)
+def _savings_chunk(
+        placement, req_video, req_endpoint, req_count,
+        link_offsets, link_caches, link_latencies, endpoint_latencies,
+        first, last):
+    saving = 0
+    for i in range(first, last):
+        video = req_video[i]
+        endpoint = req_endpoint[i]
+        max_latency = endpoint_latencies[endpoint]
+        # connections are sorted by latency: the first hit is the best
+        for j in range(link_offsets[endpoint], link_offsets[endpoint + 1]):
+            if placement[link_caches[j], video]:
+                if link_latencies[j] < max_latency:
+                    saving += (max_latency - link_latencies[j]) * req_count[i]
+                break
+    return saving
+
+
+# ======================================================================
+@njit(nogil=True, cache=True, parallel=True)
+def _savings_numba(
+        placements, req_video, req_endpoint, req_count,
+        link_offsets, link_caches, link_latencies, endpoint_latencies,
+        num_chunks):
+    """
+    Compute the total latency saving of each placement.
+
+    Requests are split in `num_chunks` contiguous chunks, which are
+    processed in parallel.
+
+    Args:
+        placements (np.ndarray[bool]): The placement matrices.
+            Must have shape (num_solutions, num_caches, num_videos).
+        req_video (np.ndarray[int]): See `Network`.
+        req_endpoint (np.ndarray[int]): See `Network`.
+        req_count (np.ndarray[int]): See `Network`.
+        link_offsets (np.ndarray[int]): See `Network`.
+        link_caches (np.ndarray[int]): See `Network`.
+        link_latencies (np.ndarray[int]): See `Network`.
+        endpoint_latencies (np.ndarray[int]): See `Network`.
+        num_chunks (int): The number of chunks of requests.
+
+    Returns:
+        savings (np.ndarray[int]): The saving of each placement.
+    """
+    num_requests = len(req_video)
+    chunk_size = (num_requests + num_chunks - 1) // num_chunks
+    savings = np.zeros(placements.shape[0], dtype=np.int64)
+    for k in range(placements.shape[0]):
+        partials = np.zeros(num_chunks, dtype=np.int64)
+        for chunk in prange(num_chunks):
+            partials[chunk] = _savings_chunk(
+                placements[k], req_video, req_endpoint, req_count,
+                link_offsets, link_caches, link_latencies, endpoint_latencies,
+                chunk * chunk_size,
+                min((chunk + 1) * chunk_size, num_requests))
+        savings[k] = np.sum(partials)
+    return savings
+
+
+# ======================================================================
+@njit(nogil=True, cache=True)
+def _savings_numba_serial(
+        placements, req_video, req_endpoint, req_count,
+        link_offsets, link_caches, link_latencies, endpoint_latencies,
+        num_chunks):
+    """
+    Compute the total latency saving of each placement (single thread).
+
+    This is the same as `_savings_numba()`, but it does not use the Numba
+    thread pool, which is not fork-safe.
+    """
+    savings = np.zeros(placements.shape[0], dtype=np.int64)
+    for k in range(placements.shape[0]):
+        savings[k] = _savings_chunk(
+            placements[k], req_video, req_endpoint, req_count,
+            link_offsets, link_caches, link_latencies, endpoint_latencies,
+            0, len(req_video))
+    return savings
+
+
+# ======================================================================
+def _score(
+        caches, req_video, req_endpoint, req_count,
+        link_offsets, link_caches, link_latencies, endpoint_latencies):
+    requests = zip(
+        req_video.tolist(), req_endpoint.tolist(), req_count.tolist())
+    link_offsets = link_offsets.tolist()
+    link_caches = link_caches.tolist()
+    link_latencies = link_latencies.tolist()
     score = 0
     num_tot = 0
     for video, endpoint, num in requests:
         num_tot += num
         latency = max_latency = endpoint_latencies[endpoint]
-        for cache, videos in enumerate(caches):
-            if video in videos:
-                cache_latency = cache_latencies[endpoint, cache]
-                if cache_latency and cache_latency < latency:
-                    latency = cache_latencies[endpoint, cache]
+        # connections are sorted by latency: the first hit is the best
+        for i in range(link_offsets[endpoint], link_offsets[endpoint + 1]):
+            if video in caches[link_caches[i]]:
+                latency = min(latency, link_latencies[i])
+                break
         score += (max_latency - latency) * num
     score = int(score / num_tot * 1000)
     return score
 
 
 # ======================================================================
-def _score_par(caches, requests, cache_latencies, endpoint_latencies):
-    pool = multiprocessing.Pool(multiprocessing.cpu_count())
-    scores, nums = [], []
-    results = [
-        pool.apply_async(
-            _score_request,
-            (caches, video, endpoint, num, cache_latencies, endpoint_latencies))
-        for video, endpoint, num in requests]
-    # todo
-    scores, nums = zip(*results)
+def _savings_numpy(
+        placements, index, latencies, starts, max_latencies, counts,
+        max_size=2 ** 25, **_kws):
+    """
+    Compute the total latency saving of each placement.
+
+    For each request, the connections are sorted by latency, so that the
+    best cache is the first one holding the video.
+
+    Args:
+        placements (np.ndarray): The flattened placement matrices.
+            Must have shape (num_solutions, num_caches * num_videos).
+        index (np.ndarray): See `Network.expanded`.
+        latencies (np.ndarray): See `Network.expanded`.
+        starts (np.ndarray): See `Network.expanded`.
+        max_latencies (np.ndarray): See `Network.expanded`.
+        counts (np.ndarray): See `Network.expanded`.
+        max_size (int): The maximum size of the temporary hit matrix.
+        **_kws: Ignored.
+
+    Returns:
+        savings (np.ndarray[int]): The saving of each placement.
+    """
+    num_solutions = len(placements)
+    savings = np.zeros(num_solutions, dtype=np.int64)
+    chunk = max(1, max_size // max(1, len(index)))
+    for i in range(0, num_solutions, chunk):
+        solutions, pairs = np.nonzero(placements[i:i + chunk, index])
+        requests = np.searchsorted(starts, pairs, side='right') - 1
+        # hits are sorted by solution, then by request, then by latency
+        is_first = np.ones(len(pairs), dtype=bool)
+        is_first[1:] = (solutions[1:] != solutions[:-1]) | \
+                       (requests[1:] != requests[:-1])
+        solutions, pairs, requests = \
+            solutions[is_first], pairs[is_first], requests[is_first]
+        gains = np.maximum(
+            max_latencies[requests] - latencies[pairs], 0) * counts[requests]
+        np.add.at(savings, i + solutions, gains)
+    return savings
 
 
 # ======================================================================
-def _score_request(
-        caches, video, endpoint, num, cache_latencies, endpoint_latencies):
-    latency = max_latency = endpoint_latencies[endpoint]
-    for cache, videos in enumerate(caches):
-        if video in videos:
-            cache_latency = cache_latencies[endpoint, cache]
-            if cache_latency and cache_latency < latency:
-                latency = cache_latencies[endpoint, cache]
-    score = (max_latency - latency) * num
-    return score, num
+def _score_par(caches, network, processes=None):
+    """
+    Compute the score in parallel over chunks of requests.
+
+    The workers and the shared memory are set up on first use for each
+    network and reused afterwards (see `quarkball.parallel`).
+
+    Args:
+        caches (list[set]|np.ndarray): The caches or the placement matrix.
+        network (Network): The network.
+        processes (int|None): The number of worker processes.
+            If None, `multiprocessing.cpu_count()` is used.
+
+    Returns:
+        score (int): The same score as `_score`.
+    """
+    from quarkball.parallel import get_scorer
+
+    placement = caches if isinstance(caches, np.ndarray) \
+        else CachingMatrix(caches, network.num_videos).placement
+    return get_scorer(network, processes).score(placement)
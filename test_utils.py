@@ -10,15 +10,26 @@ from __future__ import (
     division, absolute_import, print_function, unicode_literals)
 
 import os
+import gc
+import copy
+import pickle
+import itertools
+import time
 import datetime
 import shutil
+import tempfile
 import multiprocessing
-import profile
 
 import numpy as np
 
-from quarkball.utils import Network, Caching
+from quarkball.utils import (
+    Network, Caching, CachingMatrix, Evaluator, SCORE_ENGINES, BIN_ARRAYS,
+    knapsack, cache_loads, overflows, _placement, _score, _score_par,
+    _cache_dirpath, _compact)
 import quarkball.fill_caching as fill
+import quarkball.parallel as parallel
+import quarkball.benchmark as benchmark
+import quarkball.generate as generate
 
 DIRPATH = 'data'
 IN_DIRPATH = os.path.join(DIRPATH, 'input')
@@ -37,6 +48,94 @@ def test_network_input(
         print(network)
 
 
+# ======================================================================
+def test_network_bulk_load(
+        in_dirpath=IN_DIRPATH,
+        sources=('example', 'me_at_the_zoo', 'trending_today')):
+    for source in sources:
+        in_filepath = os.path.join(in_dirpath, source + '.in')
+        network = Network.load(in_filepath, bulk=False, cache=False)
+        bulk_network = Network.load(
+            in_filepath, bulk=True, verbose=True, cache=False)
+        assert np.array_equal(network.videos, bulk_network.videos)
+        assert np.array_equal(
+            network.endpoint_latencies, bulk_network.endpoint_latencies)
+        assert np.array_equal(
+            network.cache_latencies, bulk_network.cache_latencies)
+        assert network.cache_size == bulk_network.cache_size
+        assert network.requests == bulk_network.requests
+
+
+# ======================================================================
+def test_network_bin_cache(
+        in_dirpath=IN_DIRPATH,
+        source='me_at_the_zoo'):
+    tmp_dirpath = tempfile.mkdtemp()
+    try:
+        in_filepath = os.path.join(tmp_dirpath, source + '.in')
+        shutil.copy(os.path.join(in_dirpath, source + '.in'), in_filepath)
+        network = Network.load(in_filepath, cache=False)
+        Network.load(in_filepath, verbose=True)
+        mapped_network = Network.load(in_filepath, verbose=True)
+        assert isinstance(mapped_network.videos, np.memmap)
+        assert np.array_equal(network.videos, mapped_network.videos)
+        assert np.array_equal(
+            network.cache_latencies, mapped_network.cache_latencies)
+        assert network.requests == mapped_network.requests
+        # a sidecar changing while loading (here: incomplete) is not used
+        os.remove(os.path.join(_cache_dirpath(in_filepath), 'req_count.npy'))
+        assert np.array_equal(
+            Network.load(in_filepath).req_count, network.req_count)
+        assert isinstance(Network.load(in_filepath).videos, np.memmap)
+        # a modified input invalidates the sidecar
+        with open(in_filepath, 'a') as file:
+            file.write('\n')
+        assert not isinstance(Network.load(in_filepath).videos, np.memmap)
+    finally:
+        shutil.rmtree(tmp_dirpath)
+
+
+# ======================================================================
+def test_network_links(
+        in_dirpath=IN_DIRPATH,
+        sources=('example', 'me_at_the_zoo', 'trending_today')):
+    for source in sources:
+        in_filepath = os.path.join(in_dirpath, source + '.in')
+        network = Network.load(in_filepath, cache=False)
+        dense_network = Network.load(in_filepath, bulk=False, cache=False)
+        assert np.array_equal(
+            network.cache_latencies, dense_network.cache_latencies)
+        for endpoint in range(network.num_endpoints):
+            caches, latencies = network.links(endpoint)
+            assert np.all(np.diff(latencies) >= 0)
+            assert np.array_equal(
+                latencies, network.cache_latencies[endpoint, caches])
+        assert np.array_equal(
+            network.link_offsets, dense_network.link_offsets)
+
+
+# ======================================================================
+def test_network_merge_requests(
+        in_dirpath=IN_DIRPATH,
+        out_dirpath=OUT_DIRPATH,
+        sources=('example', 'me_at_the_zoo', 'trending_today')):
+    for source in sources:
+        in_filepath = os.path.join(in_dirpath, source + '.in')
+        network = Network.load(in_filepath)
+        merged_network = Network.load(in_filepath, merge_requests=True)
+        # the request columns use the smallest integer dtypes
+        for name in ('req_video', 'req_endpoint', 'req_count'):
+            column = getattr(network, name)
+            assert column.dtype == _compact(column.astype(np.int64)).dtype
+        assert merged_network.num_requests <= network.num_requests
+        assert np.sum(network.req_count) == np.sum(merged_network.req_count)
+        keys = (merged_network.req_endpoint.astype(np.int64) *
+                merged_network.num_videos + merged_network.req_video)
+        assert np.all(np.diff(keys) > 0)
+        caching = Caching.load(os.path.join(out_dirpath, source + '.out'))
+        assert caching.score(network) == caching.score(merged_network)
+
+
 # ======================================================================
 def test_caching_output(
         in_dirpath=OUT_DIRPATH,
@@ -48,6 +147,66 @@ def test_caching_output(
     caching.save(out_filepath)
 
 
+# ======================================================================
+def test_caching_matrix(
+        in_dirpath=IN_DIRPATH,
+        out_dirpath=OUT_DIRPATH,
+        sources=('example', 'me_at_the_zoo', 'trending_today')):
+    for source in sources:
+        in_filepath = os.path.join(in_dirpath, source + '.in')
+        network = Network.load(in_filepath)
+        out_filepath = os.path.join(out_dirpath, source + '.out')
+        caching = Caching.load(out_filepath)
+        matrix_caching = CachingMatrix.load(out_filepath, network.num_videos)
+        assert [set(videos) for videos in matrix_caching.caches] == \
+            caching.caches
+        assert matrix_caching.to_caching().caches == caching.caches
+        assert matrix_caching.score(network) == caching.score(network)
+        assert matrix_caching.validate(network.videos, network.cache_size) \
+            == caching.validate(network.videos, network.cache_size)
+        unpickled = pickle.loads(pickle.dumps(matrix_caching))
+        assert np.array_equal(unpickled.placement, matrix_caching.placement)
+        copied = copy.deepcopy(matrix_caching)
+        copied.caches[0] = {0}
+        assert copied.caches[0] == {0}
+        assert matrix_caching.caches[0] == caching.caches[0]
+        copied.clear()
+        copied.fill(network)
+        assert copied.validate(network.videos, network.cache_size)
+
+
+# ======================================================================
+def test_overflows(
+        in_dirpath=IN_DIRPATH,
+        out_dirpath=OUT_DIRPATH,
+        source='me_at_the_zoo',
+        num_solutions=8):
+    in_filepath = os.path.join(in_dirpath, source + '.in')
+    network = Network.load(in_filepath)
+    caching = Caching.load(os.path.join(out_dirpath, source + '.out'))
+    # random placements, some of which overflow
+    placements = fill._random_placements(
+        num_solutions * network.num_caches, network.videos,
+        2 * network.cache_size).reshape(num_solutions, network.num_caches, -1)
+    placements[0] = _placement(caching, network.num_videos)
+    loads = np.array([
+        [np.sum(network.videos[np.flatnonzero(row)]) for row in placement]
+        for placement in placements])
+    assert np.array_equal(cache_loads(placements, network.videos), loads)
+    packed = np.packbits(placements, axis=-1)
+    assert np.array_equal(cache_loads(packed, network.videos), loads)
+    overflow = overflows(packed, network.videos, network.cache_size)
+    assert np.array_equal(
+        overflow, np.maximum(loads - network.cache_size, 0))
+    for placement, placement_overflow in zip(placements, overflow):
+        for caching in (CachingMatrix(placement),
+                        CachingMatrix(placement).to_caching()):
+            assert caching.validate(network.videos, network.cache_size) == \
+                (not np.any(placement_overflow))
+    assert not np.any(overflow[0])
+    assert np.any(overflow)
+
+
 # ======================================================================
 def test_score(
         in_dirpath=IN_DIRPATH,
@@ -61,6 +220,630 @@ def test_score(
     print(caching.score(network))
 
 
+# ======================================================================
+def test_score_numpy(
+        in_dirpath=IN_DIRPATH,
+        out_dirpath=OUT_DIRPATH,
+        sources=('example', 'me_at_the_zoo', 'videos_worth_spreading'),
+        num_solutions=4):
+    for source in sources:
+        in_filepath = os.path.join(in_dirpath, source + '.in')
+        network = Network.load(in_filepath)
+        cachings = [Caching.load(os.path.join(out_dirpath, source + '.out'))]
+        for _ in range(num_solutions - 1):
+            caching = Caching(network.num_caches)
+            caching.fill(network)
+            cachings.append(caching)
+        ref_scores = [
+            _score(
+                caching.caches, network.req_video, network.req_endpoint,
+                network.req_count, network.link_offsets, network.link_caches,
+                network.link_latencies, network.endpoint_latencies)
+            for caching in cachings]
+        assert [caching.score(network) for caching in cachings] == ref_scores
+        placements = np.stack([
+            CachingMatrix(caching.caches, network.num_videos).placement
+            for caching in cachings])
+        assert network.score_placement(placements).tolist() == ref_scores
+        # missing caches are empty
+        short_caching = Caching(cachings[0].caches[:1])
+        padded_caching = Caching(
+            cachings[0].caches[:1] +
+            [set() for _ in range(network.num_caches - 1)])
+        for matrix in (False, True):
+            if matrix:
+                short_caching = CachingMatrix(
+                    short_caching.caches, network.num_videos)
+            assert short_caching.score(network) == \
+                padded_caching.score(network)
+
+
+# ======================================================================
+def _score_engine(in_filepath, out_filepath, engine):
+    network = Network.load(in_filepath)
+    caching = Caching.load(out_filepath)
+    placement = CachingMatrix(caching.caches, network.num_videos).placement
+    return network.score_placement(placement, engine)
+
+
+# ======================================================================
+def test_score_engines(
+        in_dirpath=IN_DIRPATH,
+        out_dirpath=OUT_DIRPATH,
+        sources=('example', 'me_at_the_zoo', 'videos_worth_spreading')):
+    # the Numba thread pool is not fork-safe: keep it out of this process
+    mp_pool = multiprocessing.get_context('spawn').Pool(1)
+    for source in sources:
+        filepaths = (
+            os.path.join(in_dirpath, source + '.in'),
+            os.path.join(out_dirpath, source + '.out'))
+        scores = [
+            mp_pool.apply(_score_engine, filepaths + (engine,))
+            if engine == 'numba_par' else _score_engine(*filepaths, engine)
+            for engine in SCORE_ENGINES]
+        print(source, dict(zip(SCORE_ENGINES, scores)))
+        assert len(set(scores)) == 1
+    mp_pool.close()
+    mp_pool.join()
+
+
+# ======================================================================
+def test_score_par(
+        in_dirpath=IN_DIRPATH,
+        out_dirpath=OUT_DIRPATH,
+        sources=('me_at_the_zoo', 'trending_today', 'videos_worth_spreading'),
+        processes=2):
+    for source in sources:
+        in_filepath = os.path.join(in_dirpath, source + '.in')
+        network = Network.load(in_filepath)
+        caching = Caching.load(os.path.join(out_dirpath, source + '.out'))
+        score = caching.score(network)
+        assert _score_par(caching.caches, network, processes) == score
+        caching.fill(network)
+        assert _score_par(caching.caches, network, processes) == \
+            caching.score(network)
+        # the persistent scorer follows the number of processes
+        assert _score_par(caching.caches, network, 1) == \
+            caching.score(network)
+        assert parallel.get_scorer(network, 1).workers.processes == 1
+        # the scorer is closed with its network
+        key = id(network)
+        del network
+        gc.collect()
+        assert key not in parallel._SCORERS
+
+
+# ======================================================================
+def test_worker_pool(
+        in_dirpath=IN_DIRPATH,
+        source='me_at_the_zoo',
+        processes=2):
+    in_filepath = os.path.join(in_dirpath, source + '.in')
+    network = Network.load(in_filepath)
+    caching = fill.CachingRandomPar(network.num_caches)
+    caching.fill(network, processes)
+    assert caching.validate(network.videos, network.cache_size)
+    tmp_dirpath = tempfile.mkdtemp()
+    try:
+        out_filepath = os.path.join(tmp_dirpath, source + '.out')
+        caching = fill.CachingEvolution(network.num_caches)
+        caching.fill(
+            network, out_filepath, max_generations=2, pool_size=10,
+            multiproc=True, processes=processes)
+        assert caching.validate(network.videos, network.cache_size)
+        population, scores, meta = fill.EvolutionCheckpoint.load(
+            os.path.join(tmp_dirpath, source + '.evo.npz'))
+        assert len(population) == len(scores) == 10
+    finally:
+        shutil.rmtree(tmp_dirpath)
+
+
+# ======================================================================
+def test_worker_pool_interrupt(
+        processes=2,
+        duration=5.0):
+    # leaving the block on an exception drops the pending tasks
+    begin_time = time.time()
+    try:
+        with parallel.WorkerPool(None, processes) as mp_pool:
+            for _ in range(2 * processes):
+                mp_pool.apply_async(time.sleep, (duration,))
+            raise KeyboardInterrupt
+    except KeyboardInterrupt:
+        pass
+    assert time.time() - begin_time < duration / 2
+
+
+# ======================================================================
+def _worker_seed_state(duration=0.05):
+    time.sleep(duration)
+    return parallel._WORKER['index'], int(np.random.get_state()[1][0])
+
+
+# ======================================================================
+def test_worker_pool_seed(
+        processes=2,
+        num_tasks=20):
+    # the streams do not depend on the pools created before
+    states = []
+    for _ in range(2):
+        with parallel.WorkerPool(None, processes, seed=0) as mp_pool:
+            results = [
+                mp_pool.apply_async(_worker_seed_state)
+                for _ in range(num_tasks)]
+            states.append(dict(result.get() for result in results))
+    assert sorted(states[0]) == list(range(processes))
+    assert states[0] == states[1]
+
+
+# ======================================================================
+def test_evolution(
+        in_dirpath=IN_DIRPATH,
+        source='me_at_the_zoo',
+        pool_size=20):
+    in_filepath = os.path.join(in_dirpath, source + '.in')
+    network = Network.load(in_filepath)
+    tmp_dirpath = tempfile.mkdtemp()
+    try:
+        out_filepath = os.path.join(tmp_dirpath, source + '.out')
+        checkpoint_filepath = os.path.join(tmp_dirpath, source + '.evo.npz')
+        scores = []
+        for export in (False, True):
+            # the second run resumes from the checkpoint
+            caching = fill.CachingEvolution(network.num_caches)
+            caching.fill(
+                network, out_filepath, max_generations=3,
+                pool_size=pool_size, multiproc=False, export=export)
+            assert caching.validate(network.videos, network.cache_size)
+            scores.append(caching.score(network))
+            population, pool_scores, meta = fill.EvolutionCheckpoint.load(
+                checkpoint_filepath)
+            assert meta['generation'] == 3 * len(scores) - 1
+            assert pool_scores[0] == scores[-1]
+            assert not np.any(overflows(
+                population, network.videos, network.cache_size))
+        assert scores[1] >= scores[0]
+        names = os.listdir(os.path.join(tmp_dirpath, source))
+        assert len(names) == pool_size
+        assert max(int(name.split('_')[0]) for name in names) == scores[1]
+        # interrupted during the third generation: the second is written
+        # (although within the checkpoint interval)
+        check_population = fill._check_population
+        calls = []
+
+        def interrupted(*args):
+            calls.append(args)
+            if len(calls) == 3:
+                raise KeyboardInterrupt
+            return check_population(*args)
+
+        fill._check_population = interrupted
+        try:
+            caching = fill.CachingEvolution(network.num_caches)
+            caching.fill(
+                network, out_filepath, max_generations=10,
+                pool_size=pool_size, multiproc=False,
+                checkpoint_interval=60.0)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            fill._check_population = check_population
+        population, pool_scores, meta = fill.EvolutionCheckpoint.load(
+            checkpoint_filepath)
+        assert meta['generation'] == 7
+    finally:
+        shutil.rmtree(tmp_dirpath)
+
+
+# ======================================================================
+def test_montecarlo_batch(
+        in_dirpath=IN_DIRPATH,
+        source='me_at_the_zoo',
+        max_iter=2000,
+        batch_size=200,
+        processes=2):
+    in_filepath = os.path.join(in_dirpath, source + '.in')
+    network = Network.load(in_filepath)
+    # the upper bound used to skip the candidates
+    gains, max_gains = fill._saving_bounds(network)
+    placements = fill._random_placements(
+        100 * network.num_caches, network.videos,
+        network.cache_size).reshape(100, network.num_caches, -1)
+    bounds = np.sum(np.minimum(
+        np.sum(placements * gains, axis=1), max_gains), axis=1)
+    assert np.all(
+        bounds / np.sum(network.req_count) * 1000 >=
+        network.score_placement(placements))
+    # connections slower than their endpoint save nothing
+    slow_network = Network.load(in_filepath)
+    slow_network.link_latencies = slow_network.link_latencies + \
+        int(np.max(slow_network.endpoint_latencies))
+    gains, max_gains = fill._saving_bounds(slow_network)
+    assert not np.any(gains) and not np.any(max_gains)
+    tmp_dirpath = tempfile.mkdtemp()
+    try:
+        out_filepath = os.path.join(tmp_dirpath, source + '.out')
+        caching = fill.CachingMonteCarlo(network.num_caches)
+        caching.fill(network, out_filepath, max_iter, batch_size)
+        assert caching.validate(network.videos, network.cache_size)
+        assert Caching.load(out_filepath).score(network) == \
+            caching.score(network) > 0
+        # parallel: reproducible for a given seed and number of processes
+        scores = []
+        for _ in range(2):
+            os.remove(out_filepath)
+            caching = fill.CachingMonteCarlo(network.num_caches)
+            caching.fill(
+                network, out_filepath, max_iter, batch_size, processes,
+                seed=0)
+            assert caching.validate(network.videos, network.cache_size)
+            scores.append(Caching.load(out_filepath).score(network))
+            assert scores[-1] == caching.score(network)
+        assert scores[0] == scores[1]
+    finally:
+        shutil.rmtree(tmp_dirpath)
+
+
+# ======================================================================
+def test_montecarlo_prefilled(
+        in_dirpath=IN_DIRPATH,
+        source='me_at_the_zoo',
+        max_iter=20,
+        batch_size=10):
+    in_filepath = os.path.join(in_dirpath, source + '.in')
+    network = Network.load(in_filepath)
+    tmp_dirpath = tempfile.mkdtemp()
+    try:
+        out_filepath = os.path.join(tmp_dirpath, source + '.out')
+        greedy = fill.CachingOptimByRequests(network.num_caches)
+        greedy.fill(network)
+        greedy_score = greedy.score(network)
+        # without improvements, the pre-filled caching is kept
+        for kws in (
+                dict(), dict(batch_size=batch_size),
+                dict(batch_size=batch_size, processes=2, seed=0)):
+            greedy.save(out_filepath)
+            caching = fill.CachingMonteCarlo(network.num_caches)
+            caching.fill(network, out_filepath, max_iter, **kws)
+            assert caching.score(network) == greedy_score
+            assert Caching.load(out_filepath).score(network) == greedy_score
+    finally:
+        shutil.rmtree(tmp_dirpath)
+
+
+# ======================================================================
+def test_evaluator(
+        in_dirpath=IN_DIRPATH,
+        out_dirpath=OUT_DIRPATH,
+        sources=('example', 'me_at_the_zoo', 'videos_worth_spreading'),
+        num_moves=200):
+    rng = np.random.RandomState(0)
+    for source in sources:
+        in_filepath = os.path.join(in_dirpath, source + '.in')
+        network = Network.load(in_filepath)
+        caching = Caching.load(os.path.join(out_dirpath, source + '.out'))
+        evaluator = Evaluator(network, caching)
+        assert evaluator.score == caching.score(network)
+        for _ in range(num_moves):
+            cache = rng.randint(network.num_caches)
+            if caching.caches[cache] and rng.rand() < 0.5:
+                video = rng.choice(sorted(caching.caches[cache]))
+                delta = evaluator.delta_remove(cache, video)
+                assert evaluator.apply(cache, video, False) == delta <= 0
+            else:
+                video = rng.randint(network.num_videos)
+                delta = evaluator.delta_add(cache, video)
+                assert evaluator.apply(cache, video, True) == delta >= 0
+            assert evaluator.score == caching.score(network)
+        assert np.array_equal(
+            evaluator.free, network.cache_size - np.array(
+                [sum(network.videos[v] for v in videos)
+                 for videos in caching.caches]))
+        gains = evaluator.gains()
+        for video in rng.randint(network.num_videos, size=10):
+            assert np.array_equal(evaluator.video_gains(video), gains[:, video])
+            cache = rng.randint(network.num_caches)
+            assert evaluator.delta_add(cache, video) == gains[cache, video]
+
+
+# ======================================================================
+def test_greedy_gain(
+        in_dirpath=IN_DIRPATH,
+        out_dirpath=OUT_DIRPATH,
+        sources=('example', 'me_at_the_zoo', 'videos_worth_spreading')):
+    for source in sources:
+        in_filepath = os.path.join(in_dirpath, source + '.in')
+        network = Network.load(in_filepath)
+        caching = fill.CachingGreedyGain(network.num_caches)
+        caching.fill(network)
+        score = caching.score(network)
+        print('{:20s} greedy gain score: {}'.format(source, score))
+        assert caching.validate(network.videos, network.cache_size)
+        assert score >= Caching.load(
+            os.path.join(out_dirpath, source + '.out')).score(network)
+
+
+# ======================================================================
+def test_block_ascent(
+        in_dirpath=IN_DIRPATH,
+        out_dirpath=OUT_DIRPATH,
+        sources=('example', 'me_at_the_zoo'),
+        processes=2):
+    for source in sources:
+        in_filepath = os.path.join(in_dirpath, source + '.in')
+        network = Network.load(in_filepath)
+        caching = Caching.load(os.path.join(out_dirpath, source + '.out'))
+        evaluator = Evaluator(network, caching)
+        for cache in range(network.num_caches):
+            emptied = copy.deepcopy(caching)
+            emptied.caches[cache] = set()
+            emptied_evaluator = Evaluator(network, emptied)
+            assert np.array_equal(
+                evaluator.cache_gains(cache),
+                [emptied_evaluator.delta_add(cache, video)
+                 for video in range(network.num_videos)])
+        block_caching = fill.CachingBlockAscent(network.num_caches)
+        block_caching.caches = copy.deepcopy(caching.caches)
+        block_caching.fill(network, processes=processes)
+        assert block_caching.validate(network.videos, network.cache_size)
+        assert block_caching.score(network) >= caching.score(network)
+
+
+# ======================================================================
+def test_local_search(
+        in_dirpath=IN_DIRPATH,
+        out_dirpath=OUT_DIRPATH,
+        source='me_at_the_zoo'):
+    in_filepath = os.path.join(in_dirpath, source + '.in')
+    network = Network.load(in_filepath)
+    tmp_dirpath = tempfile.mkdtemp()
+    try:
+        out_filepath = os.path.join(tmp_dirpath, source + '.out')
+        for strategy in ('first', 'best'):
+            shutil.copy(
+                os.path.join(out_dirpath, source + '.out'), out_filepath)
+            score = Caching.load(out_filepath).score(network)
+            caching = fill.CachingLocalSearch(network.num_caches)
+            caching.fill(network, out_filepath, strategy, max_time=10)
+            assert caching.validate(network.videos, network.cache_size)
+            assert Caching.load(out_filepath).score(network) == \
+                caching.score(network) > score
+    finally:
+        shutil.rmtree(tmp_dirpath)
+
+
+# ======================================================================
+def test_annealing(
+        in_dirpath=IN_DIRPATH,
+        out_dirpath=OUT_DIRPATH,
+        source='me_at_the_zoo',
+        max_time=2.0):
+    in_filepath = os.path.join(in_dirpath, source + '.in')
+    network = Network.load(in_filepath)
+    tmp_dirpath = tempfile.mkdtemp()
+    try:
+        out_filepath = os.path.join(tmp_dirpath, source + '.out')
+        shutil.copy(os.path.join(out_dirpath, source + '.out'), out_filepath)
+        score = Caching.load(out_filepath).score(network)
+        caching = fill.CachingAnnealing(network.num_caches)
+        caching.fill(
+            network, out_filepath, max_time=max_time, reheat_after=10000)
+        assert caching.validate(network.videos, network.cache_size)
+        assert Caching.load(out_filepath).score(network) == \
+            caching.score(network) >= score
+    finally:
+        shutil.rmtree(tmp_dirpath)
+
+
+# ======================================================================
+def test_knapsack(
+        num_tests=200,
+        max_items=9):
+    rng = np.random.RandomState(0)
+    for _ in range(num_tests):
+        num_items = rng.randint(1, max_items + 1)
+        values = rng.randint(-5, 50, num_items)
+        sizes = rng.randint(1, 30, num_items)
+        capacity = rng.randint(0, 100)
+        best_value = max(
+            np.sum(values[list(items)])
+            for num in range(num_items + 1)
+            for items in itertools.combinations(range(num_items), num)
+            if np.sum(sizes[list(items)]) <= capacity)
+        items = knapsack(values, sizes, capacity)
+        assert np.sum(sizes[items]) <= capacity
+        assert np.sum(values[items]) == best_value
+        items = knapsack(values, sizes, capacity, max_capacity=8)
+        assert np.sum(sizes[items]) <= capacity
+
+
+# ======================================================================
+def test_optim_by(
+        in_dirpath=IN_DIRPATH,
+        sources=('me_at_the_zoo', 'trending_today', 'videos_worth_spreading'),
+        max_time=1.0):
+    expected = {
+        ('me_at_the_zoo', fill.CachingOptimByRequests): 282218,
+        ('me_at_the_zoo', fill.CachingOptimByCaches): 282626}
+    for source in sources:
+        in_filepath = os.path.join(in_dirpath, source + '.in')
+        network = Network.load(in_filepath)
+        for fill_cls in (
+                fill.CachingOptimByRequests, fill.CachingOptimByCaches):
+            caching = fill_cls(network.num_caches)
+            begin_time = datetime.datetime.now()
+            caching.fill(network)
+            elapsed = datetime.datetime.now() - begin_time
+            score = caching.score(network)
+            print('{:20s} {}: {} ({})'.format(
+                source, fill_cls.__name__, score, elapsed))
+            assert caching.validate(network.videos, network.cache_size)
+            assert elapsed.total_seconds() < max_time
+            if (source, fill_cls) in expected:
+                assert score == expected[source, fill_cls]
+
+
+# ======================================================================
+def test_upper_bound(
+        in_dirpath=IN_DIRPATH,
+        out_dirpath=OUT_DIRPATH,
+        sources=(
+            'example', 'me_at_the_zoo', 'trending_today',
+            'videos_worth_spreading'),
+        source='me_at_the_zoo',
+        stop_at_gap=0.4):
+    for name in sources:
+        in_filepath = os.path.join(in_dirpath, name + '.in')
+        network = Network.load(in_filepath)
+        upper_bound = network.upper_bound()
+        # the requests are expanded in chunks, not with `Network.expanded`
+        assert network._expanded is None
+        network._upper_bound = None
+        assert network.upper_bound(chunk_size=1000) == upper_bound
+        score = Caching.load(os.path.join(out_dirpath, name + '.out')).score(
+            network)
+        print('{:20s} upper bound: {}  gap={:.3%}'.format(
+            name, network.upper_bound(), network.gap(score)))
+        assert network.upper_bound() >= score
+        assert 0 <= network.gap(score) < 1
+    # no other stopping criterion: only stops when the gap is reached
+    in_filepath = os.path.join(in_dirpath, source + '.in')
+    network = Network.load(in_filepath)
+    tmp_dirpath = tempfile.mkdtemp()
+    try:
+        out_filepath = os.path.join(tmp_dirpath, source + '.out')
+        shutil.copy(os.path.join(out_dirpath, source + '.out'), out_filepath)
+        assert network.gap(Caching.load(out_filepath).score(network)) > \
+            stop_at_gap
+        caching = fill.CachingAnnealing(network.num_caches)
+        caching.fill(
+            network, out_filepath, max_iter=int(1e12), reheat_after=None,
+            stop_at_gap=stop_at_gap)
+        assert network.gap(caching.score(network)) <= stop_at_gap
+        assert Caching.load(out_filepath).score(network) == \
+            caching.score(network)
+    finally:
+        shutil.rmtree(tmp_dirpath)
+
+
+# ======================================================================
+def test_bruteforce(
+        in_dirpath=IN_DIRPATH,
+        source='example',
+        num_tests=30):
+    rng = np.random.RandomState(0)
+    for _ in range(num_tests):
+        num_videos, num_endpoints, num_caches = \
+            rng.randint(2, 6), rng.randint(1, 4), rng.randint(1, 3)
+        videos = rng.randint(1, 10, num_videos)
+        cache_size = rng.randint(5, 20)
+        latencies = rng.randint(1, 200, (num_endpoints, num_caches)) * \
+            (rng.rand(num_endpoints, num_caches) < 0.8)
+        requests = [
+            (rng.randint(num_videos), rng.randint(num_endpoints),
+             rng.randint(1, 100))
+            for _ in range(rng.randint(1, 12))]
+        network = Network(
+            videos, rng.randint(200, 1000, num_endpoints), cache_size,
+            latencies, requests)
+        contents = [
+            [video in items for video in range(num_videos)]
+            for num in range(num_videos + 1)
+            for items in itertools.combinations(range(num_videos), num)
+            if np.sum(videos[list(items)]) <= cache_size]
+        best_score = max(
+            network.score_placement(np.array(placement))
+            for placement in itertools.product(contents, repeat=num_caches))
+        caching = fill.CachingBruteForce(num_caches)
+        caching.fill(network)
+        assert caching.validate(videos, cache_size)
+        assert caching.score(network) == best_score
+        assert network.upper_bound() >= best_score
+    in_filepath = os.path.join(in_dirpath, source + '.in')
+    network = Network.load(in_filepath)
+    tmp_dirpath = tempfile.mkdtemp()
+    try:
+        out_filepath = os.path.join(tmp_dirpath, source + '.out')
+        caching = fill.CachingBruteForce(network.num_caches)
+        caching.fill(network, out_filepath)
+        assert Caching.load(out_filepath).score(network) == \
+            caching.score(network) == 562500
+    finally:
+        shutil.rmtree(tmp_dirpath)
+
+
+# ======================================================================
+def test_benchmark(
+        in_dirpath=IN_DIRPATH,
+        out_dirpath=OUT_DIRPATH,
+        source='example'):
+    # 'numba_par' is skipped: processes are forked by the following tests
+    benchmarks = [
+        name for name in benchmark.BENCHMARKS if name != 'score_numba_par']
+    results = benchmark.run(
+        [source], benchmarks, in_dirpath, out_dirpath, repeat=2, warmup=1)
+    assert len(results['results']) == len(benchmarks)
+    assert all(len(entry['times']) == 2 for entry in results['results'])
+    tmp_dirpath = tempfile.mkdtemp()
+    try:
+        filepath = os.path.join(tmp_dirpath, 'benchmark.json')
+        benchmark.save(results, filepath)
+        baseline = benchmark.load(filepath)
+        assert baseline == results
+        # same seed: same scores
+        rerun = benchmark.run(
+            [source], ['fill_annealing', 'fill_evolution'], in_dirpath,
+            out_dirpath, repeat=1, warmup=0)
+        assert not [
+            regression for regression in benchmark.compare(rerun, baseline)
+            if regression['kind'] == 'score']
+        # a faster baseline with higher scores
+        for entry in baseline['results']:
+            entry['median'] /= 10
+            entry['median'] -= 1
+            if 'score' in entry:
+                entry['score'] += 1
+        regressions = benchmark.compare(results, baseline)
+        assert {(regression['benchmark'], regression['kind'])
+                for regression in regressions} == \
+            {(entry['benchmark'], 'time') for entry in results['results']} | \
+            {(entry['benchmark'], 'score') for entry in results['results']
+             if 'score' in entry}
+    finally:
+        shutil.rmtree(tmp_dirpath)
+
+
+# ======================================================================
+def test_generate():
+    tmp_dirpath = tempfile.mkdtemp()
+    try:
+        filepaths = [
+            os.path.join(tmp_dirpath, name + '.in') for name in 'ab']
+        for degree in generate.DEGREES:
+            # the output does not depend on the chunk size
+            for filepath, chunk_size in zip(filepaths, (2 ** 20, 17)):
+                generate.generate(
+                    filepath, 300, 40, 12, 2000, degree=degree,
+                    max_degree=5, seed=0, chunk_size=chunk_size)
+            with open(filepaths[0], 'rb') as file_a, \
+                    open(filepaths[1], 'rb') as file_b:
+                assert file_a.read() == file_b.read()
+            # the binary sidecar matches the parsed file
+            parsed = Network.load(filepaths[0], cache=False)
+            mapped = Network.load(filepaths[0])
+            assert isinstance(mapped.videos, np.memmap)
+            for name in BIN_ARRAYS:
+                assert getattr(parsed, name).dtype == \
+                    getattr(mapped, name).dtype
+                assert np.array_equal(
+                    getattr(parsed, name), getattr(mapped, name))
+            assert parsed.num_caches == 12 and len(parsed.req_count) == 2000
+            if degree == 'constant':
+                assert np.all(np.diff(parsed.link_offsets) == 5)
+    finally:
+        shutil.rmtree(tmp_dirpath)
+
+
 # ======================================================================
 def test_fill(
         in_dirpath=IN_DIRPATH,
@@ -92,7 +875,8 @@ def test_method(
     caching.fill(network, *fill_args, **fill_kws)
     caching.save(out_filepath)
     score = caching.score(network)
-    print('{:20s} final score: {}'.format(source, score), flush=True)
+    print('{:20s} final score: {}  gap={:.3%}'.format(
+        source, score, network.gap(score)), flush=True)
     return score
 
 
@@ -116,7 +900,8 @@ def test_method_seq(
         caching.save(out_filepath)
         score = caching.score(network)
         tot_score += score
-        print('{:40s} score: {}'.format(source, score))
+        print('{:40s} score: {}  gap={:.3%}'.format(
+            source, score, network.gap(score)))
     print('\nTOTAL SCORE: {}\n'.format(tot_score))
 
 
@@ -131,15 +916,15 @@ def test_method_par(
     if not os.path.isdir(out_dirpath):
         os.makedirs(out_dirpath)
     tot_score = 0
-    pool = multiprocessing.Pool(multiprocessing.cpu_count())
-    results = [
-        pool.apply_async(
-            test_method,
-            (in_dirpath, out_dirpath, source, fill_cls,) + fill_args,
-            fill_kws)
-        for source in sources]
-    for result in results:
-        tot_score += result.get()
+    with parallel.WorkerPool() as pool:
+        results = [
+            pool.apply_async(
+                test_method,
+                (in_dirpath, out_dirpath, source, fill_cls,) + fill_args,
+                fill_kws)
+            for source in sources]
+        for result in results:
+            tot_score += result.get()
     print('\nTOTAL SCORE: {}\n'.format(tot_score))
 
 
@@ -152,15 +937,15 @@ def bruteforce(
     if not os.path.isdir(out_dirpath):
         os.makedirs(out_dirpath)
     tot_score = 0
-    mp_pool = multiprocessing.Pool(multiprocessing.cpu_count())
-    results = [
-        mp_pool.apply_async(
-            test_method,
-            (in_dirpath, out_dirpath, source, fill.CachingBruteForce,
-             os.path.join(out_dirpath, source + '.out')))
-        for source in sources]
-    for result in results:
-        tot_score += result.get()
+    with parallel.WorkerPool() as mp_pool:
+        results = [
+            mp_pool.apply_async(
+                test_method,
+                (in_dirpath, out_dirpath, source, fill.CachingBruteForce,
+                 os.path.join(out_dirpath, source + '.out')))
+            for source in sources]
+        for result in results:
+            tot_score += result.get()
     print('\nTOTAL SCORE: {}\n'.format(tot_score))
 
 
@@ -169,13 +954,17 @@ def montecarlo(
         in_dirpath=IN_DIRPATH,
         out_dirpath=os.path.join(OUT_DIRPATH, 'montecarlo'),
         source='example',
-        max_iter=int(1e8 - 1)):
+        max_iter=int(1e8 - 1),
+        batch_size=None,
+        processes=1,
+        seed=None):
     print('Montecarlo')
     if not os.path.isdir(out_dirpath):
         os.makedirs(out_dirpath)
     test_method(
         in_dirpath, out_dirpath, source, fill.CachingMonteCarlo,
-        os.path.join(out_dirpath, source + '.out'), max_iter)
+        os.path.join(out_dirpath, source + '.out'), max_iter, batch_size,
+        processes, seed)
 
 
 # ======================================================================
@@ -214,8 +1003,6 @@ def main():
     # montecarlo(sources=SOURCES[1])
     # evolution(source=SOURCES[0])
     evolution(source=SOURCES[1], multiproc=False)
-    # profile.run(
-    #     "test_method(source=SOURCES[3], fill_cls=fill.Caching)")
 
     end_time = datetime.datetime.now()
     print('\nExecTime: {}'.format(end_time - begin_time))